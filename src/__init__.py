@@ -1,17 +1,32 @@
 """
 A package for implementing peer-to-peer networking with NAT traversal.
+
+Submodules are imported on first attribute access so that each mode only
+pays for what it uses.
 """
+import importlib
+
+_EXPORTS = {
+    'Peer': '.peer',
+    'Server': '.server',
+    'ClusterServer': '.cluster',
+    'Client': '.client',
+    'PeerConnection': '.connection',
+    'PeerConnectionPool': '.connection',
+    'create_punch_socket': '.nat',
+    'punch_hole': '.nat',
+    'establish_p2p_connection': '.nat',
+}
+
+__all__ = list(_EXPORTS)
 
-from .peer import Peer
-from .server import Server
-from .client import Client
-from .nat import create_punch_socket, punch_hole, establish_p2p_connection
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
 
-__all__ = [
-    'Peer',
-    'Server',
-    'Client',
-    'create_punch_socket',
-    'punch_hole',
-    'establish_p2p_connection'
-]
+def __dir__():
+    return sorted(list(globals()) + __all__)
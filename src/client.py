@@ -1,15 +1,26 @@
 import asyncio
+import itertools
 import logging
 import json
+import socket
+import uuid
 from typing import Optional, Dict
 from .peer import Peer
+from .connection import PeerConnection
+from .nat import tcp_hole_punch_stream
 
 logger = logging.getLogger(__name__)
 
+# Seconds a finished connect() still recognises the target's punch reply
+PUNCH_REPLY_GRACE = 60.0
+
 class Client:
-    def __init__(self, server_host: str, server_port: int):
+    def __init__(self, server_host: str, server_port: int, interactive: bool = True,
+                 max_concurrent_connects: int = 64):
         self.server_host = server_host
         self.server_port = server_port
+        self.interactive = interactive
+        self.max_concurrent_connects = max_concurrent_connects
         self.peer_id: Optional[str] = None
         self.peers: Dict[str, Peer] = {}
         self.reader: Optional[asyncio.StreamReader] = None
@@ -18,6 +29,20 @@ class Client:
         self.relay_port: Optional[int] = None
         self.relay_target_host: Optional[str] = None
         self.relay_target_port: Optional[int] = None
+        self.relay_compress_level: Optional[int] = None
+        self.relay_migrate = False
+        self.tags: Dict[str, str] = {}
+        self.reuse_port = False
+        self.incoming_connections: Optional[asyncio.Queue] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Request IDs are echoed to other peers, so they carry a per-client prefix
+        self._request_prefix = uuid.uuid4().hex[:8]
+        self._request_ids = itertools.count(1)
+        # request_id -> target_id of connects started by this client
+        self._connects: Dict[str, str] = {}
+        self._connect_semaphore: Optional[asyncio.Semaphore] = None
+        self._send_lock: Optional[asyncio.Lock] = None
+        self._loop_task: Optional[asyncio.Task] = None
 
     async def start(self):
         """Start the client and connect to the server."""
@@ -31,7 +56,6 @@ class Client:
             await self.register()
 
             # If running in client-app mode, request relay
-            import sys
             if hasattr(self, 'relay_port') and hasattr(self, 'relay_target_host') and hasattr(self, 'relay_target_port'):
                 await self.request_relay()
 
@@ -45,6 +69,157 @@ class Client:
                 self.writer.close()
                 await self.writer.wait_closed()
 
+    async def open(self):
+        """
+        Connect and register without blocking, for programmatic (headless) use.
+        The message loop runs in the background until close() is called.
+        """
+        sock = await self._open_reusable_socket()
+        if sock is not None:
+            self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.server_host, self.server_port
+            )
+        logger.info(f"Connected to server at {self.server_host}:{self.server_port}")
+        if self.incoming_connections is None:
+            self.incoming_connections = asyncio.Queue()
+        try:
+            await self.register()
+        except Exception:
+            await self.close()
+            raise
+        self._loop_task = asyncio.create_task(self.message_loop())
+
+    async def close(self):
+        """Stop the background message loop and disconnect from the server."""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        self._fail_pending(ConnectionError("Client closed"))
+        if self.writer and not self.writer.is_closing():
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def connect(self, target_id: str, timeout: Optional[float] = 30.0) -> PeerConnection:
+        """
+        Connect to another peer and return the established PeerConnection.
+
+        Up to max_concurrent_connects calls run in parallel; the server's
+        connect_ready (or error) reply and the target's punch reply are matched
+        to this call by request ID, so the reply does not start a second punch.
+        timeout (seconds, None for no limit) covers the whole call: waiting for
+        a free connect slot, the server's reply and the hole punch itself.
+        Raises ConnectionError if the peer is unknown or hole punching fails,
+        asyncio.TimeoutError if the timeout expires first.
+        """
+        if self._connect_semaphore is None:
+            self._connect_semaphore = asyncio.Semaphore(self.max_concurrent_connects)
+        return await asyncio.wait_for(self._connect(target_id), timeout)
+
+    async def _connect(self, target_id: str) -> PeerConnection:
+        async with self._connect_semaphore:
+            request_id = self._next_request_id()
+            fut = asyncio.get_event_loop().create_future()
+            self._pending[request_id] = fut
+            self._connects[request_id] = target_id
+            try:
+                await self._send_to_server({
+                    'type': 'connect',
+                    'target_id': target_id,
+                    'request_id': request_id
+                })
+                reply = await fut
+            except BaseException:
+                self._connects.pop(request_id, None)
+                raise
+            finally:
+                self._pending.pop(request_id, None)
+
+            try:
+                target_addr = reply['target_addr']
+                await self._send_to_server({
+                    'type': 'punch',
+                    'target_id': target_id,
+                    'port': target_addr[1],
+                    'target_addr': target_addr,
+                    'request_id': request_id
+                })
+                stream = await self._punch(target_addr)
+            finally:
+                # The target's punch reply may still be on its way
+                asyncio.get_event_loop().call_later(PUNCH_REPLY_GRACE, self._connects.pop, request_id, None)
+            if stream is None:
+                raise ConnectionError(f"Hole punch to {target_id} failed")
+            return PeerConnection(target_id, target_addr, *stream)
+
+    def _next_request_id(self) -> str:
+        return f"{self._request_prefix}-{next(self._request_ids)}"
+
+    async def _open_reusable_socket(self) -> Optional[socket.socket]:
+        """
+        Connect to the server from a SO_REUSEPORT socket so that concurrent
+        hole punches can listen on the same local port. Returns None where
+        SO_REUSEPORT is unavailable.
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            return None
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(self.server_host, self.server_port, type=socket.SOCK_STREAM)
+        family, type_, proto, _, addr = infos[0]
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Bind explicitly: a port picked by connect() may later be shared by other
+            # outgoing connections, which would block the punch listener on it
+            sock.bind(('', 0))
+            sock.setblocking(False)
+            await loop.sock_connect(sock, addr)
+        except Exception:
+            sock.close()
+            raise
+        self.reuse_port = True
+        return sock
+
+    async def query_peers(self, tags: Optional[Dict[str, str]] = None, limit: int = 100,
+                          cursor: Optional[str] = None, timeout: Optional[float] = 30.0) -> dict:
+        """
+        Ask the server for one page of peers whose tags include all of tags.
+        Returns the query_result message: 'peers' is a list of {peer_id, tags}
+        and 'next_cursor' is passed back as cursor to fetch the next page.
+        """
+        request_id = self._next_request_id()
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = fut
+        query = {'type': 'query_peers', 'request_id': request_id, 'limit': limit}
+        if tags:
+            query['tags'] = tags
+        if cursor is not None:
+            query['cursor'] = cursor
+        try:
+            await self._send_to_server(query)
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _punch(self, target_addr):
+        if self.listen_port is None:
+            raise ConnectionError("No listen_port set for TCP hole punching")
+        peer_ip, peer_port = target_addr
+        return await tcp_hole_punch_stream('0.0.0.0', self.listen_port, peer_ip, peer_port,
+                                           reuse_port=self.reuse_port)
+
+    def _fail_pending(self, exc: Exception):
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        self._pending.clear()
+
     async def request_relay(self):
         """Send a relay request to the server."""
         relay_msg = {
@@ -61,6 +236,8 @@ class Client:
         register_msg = {
             'type': 'register'
         }
+        if self.tags:
+            register_msg['tags'] = self.tags
         await self._send_to_server(register_msg)
 
         response = await self._receive_from_server()
@@ -68,13 +245,17 @@ class Client:
             self.peer_id = response.get('peer_id')
             logger.info(f"Registered with server, assigned ID: {self.peer_id}")
             if self.peer_id:
-                ip, port = self.peer_id.split(":")
+                ip, port = self.peer_id.rsplit(":", 1)
                 self.listen_port = int(port)
                 # If running in client-app mode, start relay locally
-                import sys
                 if hasattr(self, 'relay_target_host') and hasattr(self, 'relay_target_port') and self.relay_target_host and self.relay_target_port:
-                    from src.tcp_relay import TCPRelayServer
-                    relay = TCPRelayServer('0.0.0.0', self.listen_port, self.relay_target_host, self.relay_target_port)
+                    # Only client-app mode needs the relay (and its compression stack)
+                    from .tcp_relay import TCPRelayServer
+                    relay = TCPRelayServer('0.0.0.0', self.listen_port, self.relay_target_host, self.relay_target_port,
+                                           compress_level=self.relay_compress_level,
+                                           compress_side='target' if self.relay_compress_level or self.relay_migrate else None,
+                                           migrate=self.relay_migrate,
+                                           rendezvous=(self.server_host, self.server_port) if self.relay_migrate else None)
                     logger.info(f"Starting local relay on 0.0.0.0:{self.listen_port} -> {self.relay_target_host}:{self.relay_target_port}")
                     asyncio.create_task(relay.start())
         else:
@@ -92,7 +273,8 @@ class Client:
         """Main message handling loop."""
         try:
             # Start user input handling in the background
-            asyncio.create_task(self.handle_user_input())
+            if self.interactive:
+                asyncio.create_task(self.handle_user_input())
             
             while True:
                 if not self.reader:
@@ -105,13 +287,15 @@ class Client:
                 await self.handle_message(message)
         except Exception as e:
             logger.error(f"Error in message loop: {e}")
+        finally:
+            self._fail_pending(ConnectionError("Server connection lost"))
 
     async def handle_user_input(self):
         """Handle user commands from stdin."""
         while True:
             try:
                 command = await asyncio.get_event_loop().run_in_executor(
-                    None, input, "Enter command (connect <peer_id>, list, or quit): "
+                    None, input, "Enter command (connect <peer_id>, list, query [key=value ...], or quit): "
                 )
                 
                 if command.startswith("connect "):
@@ -120,6 +304,9 @@ class Client:
                     await self.connect_to_peer(peer_id)
                 elif command == "list":
                     await self._send_to_server({'type': 'list_peers'})
+                elif command == "query" or command.startswith("query "):
+                    tags = dict(item.split("=", 1) for item in command.split()[1:] if "=" in item)
+                    await self._send_to_server({'type': 'query_peers', 'tags': tags})
                 elif command == "quit":
                     logger.info("Shutting down...")
                     break
@@ -132,14 +319,36 @@ class Client:
         if not msg_type:
             return
 
+        request_id = message.get('request_id')
+        if msg_type == 'punch' and self._connects.pop(request_id, None) is not None:
+            # The target answered a connect() of ours, which is already punching
+            logger.debug(f"Punch reply from {message.get('peer_id')} for request {request_id}")
+            return
+
+        fut = self._pending.get(request_id)
+        if fut is not None:
+            if fut.done():
+                return
+            if msg_type == 'error':
+                fut.set_exception(ConnectionError(message.get('message')))
+            else:
+                fut.set_result(message)
+            return
+
         if msg_type == 'connect_ready':
             await self.handle_connect_ready(message)
         elif msg_type == 'punch':
-            await self.handle_punch(message)
+            if self.interactive:
+                await self.handle_punch(message)
+            else:
+                # Punch in the background so the message loop keeps serving other replies
+                asyncio.create_task(self.handle_punch(message))
         elif msg_type == 'error':
             logger.error(f"Received error: {message.get('message')}")
         elif msg_type == 'peer_list':
             logger.info(f"Registered peers: {message.get('peers')}")
+        elif msg_type == 'query_result':
+            logger.info(f"Matching peers: {message.get('peers')} (next cursor: {message.get('next_cursor')})")
 
     async def handle_connect_ready(self, message: dict):
         """Handle connection ready message."""
@@ -158,6 +367,9 @@ class Client:
             'port': peer_port,
             'target_addr': target_addr
         }
+        if message.get('request_id') is not None:
+            # Lets the initiator match this reply to its connect()
+            punch_msg['request_id'] = message['request_id']
         await self._send_to_server(punch_msg)
 
     async def handle_punch(self, message: dict):
@@ -170,13 +382,18 @@ class Client:
             return
         peer_ip, peer_port = target_addr
         logger.info(f"Received punch request from {peer_id} at {peer_ip}:{peer_port} (TCP)")
-        from .nat import tcp_hole_punch
         if self.listen_port is None:
             logger.error("No listen_port set for TCP hole punching!")
             return
-        sock = await tcp_hole_punch('0.0.0.0', self.listen_port, peer_ip, peer_port)
-        if sock:
-            logger.info(f"TCP hole punch successful: {sock.getsockname()} <-> {sock.getpeername()}")
+        stream = await tcp_hole_punch_stream('0.0.0.0', self.listen_port, peer_ip, peer_port,
+                                             reuse_port=self.reuse_port)
+        if stream:
+            if self.incoming_connections is not None:
+                self.incoming_connections.put_nowait(PeerConnection(peer_id, target_addr, *stream))
+            else:
+                # Interactive mode has nobody to hand the link to
+                logger.info(f"Closing punched link from {peer_id}: no consumer for incoming connections")
+                stream[1].close()
         else:
             logger.warning("TCP hole punch failed after all retries")
 
@@ -185,10 +402,13 @@ class Client:
         if not self.writer:
             raise Exception("Not connected to server")
         
+        if self._send_lock is None:
+            self._send_lock = asyncio.Lock()
         try:
             data = json.dumps(message).encode()
-            self.writer.write(data + b'\n')
-            await self.writer.drain()
+            async with self._send_lock:
+                self.writer.write(data + b'\n')
+                await self.writer.drain()
         except Exception as e:
             logger.error(f"Error sending message to server: {e}")
             raise
@@ -0,0 +1,344 @@
+"""
+This module contains the multi-node rendezvous cluster.
+
+Every ClusterServer keeps a replicated peer directory mapping peer ID to the
+owning node and the peer's public address. Nodes form a full mesh over the
+same JSON-line protocol used by peers, but on a separate cluster port: a
+node_challenge/node_hello/node_welcome exchange authenticates both ends with
+an HMAC over a shared secret and carries a directory snapshot and the known
+node addresses; later registrations and disconnects are pushed as dir_update
+messages. Peer IDs are namespaced by the owning node ("<node_id>/<ip>:<port>")
+and a node may only add or remove IDs in its own namespace. Peer tags travel
+with directory entries so tag_index covers the whole cluster. connect and
+punch messages for a peer owned by another node are forwarded to that node.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import secrets
+import uuid
+from typing import Dict, List, Optional, Tuple
+from .peer import Peer
+from .server import Server
+
+logger = logging.getLogger(__name__)
+
+HANDSHAKE_TIMEOUT = 10.0
+# Backoff between attempts to re-link a node whose link dropped
+REDIAL_MIN_DELAY = 0.5
+REDIAL_MAX_DELAY = 30.0
+
+def _auth(secret: bytes, nonce: str, node_id: str) -> str:
+    """Proof that node_id knows the cluster secret, bound to the other side's nonce."""
+    return hmac.new(secret, f"{nonce}:{node_id}".encode(), hashlib.sha256).hexdigest()
+
+class ClusterServer(Server):
+    def __init__(self, host: str, port: int, node_id: Optional[str] = None,
+                 seeds: Optional[List[Tuple[str, int]]] = None, advertise_host: Optional[str] = None,
+                 secret: Optional[str] = None, cluster_host: Optional[str] = None, cluster_port: int = 0):
+        """
+        Clients connect to (host, port); other nodes link to (cluster_host,
+        cluster_port), which defaults to host and should not be exposed
+        publicly. seeds are cluster addresses of other nodes. Every node must
+        be configured with the same secret. advertise_host is the address other
+        nodes dial to reach cluster_port; when it is not given and cluster_host
+        is a wildcard, other nodes use the source address of our link instead.
+        """
+        super().__init__(host, port)
+        if not secret:
+            raise ValueError("A cluster secret is required")
+        self.node_id = node_id or uuid.uuid4().hex[:12]
+        if '/' in self.node_id:
+            raise ValueError(f"Invalid node ID: {self.node_id!r}")
+        self.secret = secret.encode()
+        self.seeds = list(seeds or [])
+        self.cluster_host = host if cluster_host is None else cluster_host
+        self.cluster_port = cluster_port
+        self.advertise_host = advertise_host or (self.cluster_host if self.cluster_host not in ('', '0.0.0.0', '::') else None)
+        # peer_id -> (node_id, public_addr) for every registered peer in the cluster
+        self.directory: Dict[str, Tuple[str, list]] = {}
+        # node_id -> link to that node
+        self.nodes: Dict[str, Peer] = {}
+        self.node_addrs: Dict[str, list] = {}
+        self._dialing = set()
+        # node_id -> task re-linking a node whose link dropped
+        self._redials: Dict[str, asyncio.Task] = {}
+        self._stopped = False
+
+    @property
+    def addr(self) -> list:
+        return [self.advertise_host, self.cluster_port]
+
+    async def start(self):
+        """Start serving clients and nodes, and join the cluster through the configured seeds."""
+        cluster_server = await asyncio.start_server(
+            self.handle_node_connection, self.cluster_host, self.cluster_port
+        )
+        if self.cluster_port == 0:
+            self.cluster_port = cluster_server.sockets[0].getsockname()[1]
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port
+        )
+        if self.port == 0:
+            self.port = server.sockets[0].getsockname()[1]
+        logger.info(f"Cluster node {self.node_id} serving on {server.sockets[0].getsockname()}, "
+                    f"cluster port {self.cluster_port}")
+        for host, port in self.seeds:
+            asyncio.create_task(self.link_to(host, port))
+
+        try:
+            async with cluster_server, server:
+                await asyncio.gather(server.serve_forever(), cluster_server.serve_forever())
+        finally:
+            self._stopped = True
+            for task in list(self._redials.values()):
+                task.cancel()
+
+    def make_peer_id(self, addr) -> str:
+        return f"{self.node_id}/{addr[0]}:{addr[1]}"
+
+    def _hello(self, msg_type: str) -> dict:
+        return {
+            'type': msg_type,
+            'node_id': self.node_id,
+            'addr': self.addr,
+            'nodes': [[node_id, addr] for node_id, addr in self.node_addrs.items()],
+            'directory': [[peer_id, owner, addr, self.tag_index.tags.get(peer_id, {})]
+                          for peer_id, (owner, addr) in self.directory.items() if owner == self.node_id]
+        }
+
+    async def link_to(self, host: str, port: int, retries: int = 5, delay: float = 0.5) -> bool:
+        """
+        Open a link to another node's cluster port and serve it until it
+        closes. Returns whether a link was established.
+        """
+        key = (host, port)
+        if key in self._dialing or list(key) == self.addr:
+            return False
+        self._dialing.add(key)
+        try:
+            for attempt in range(retries):
+                try:
+                    reader, writer = await asyncio.open_connection(host, port)
+                    break
+                except OSError as e:
+                    logger.debug(f"Link to node {host}:{port} failed (attempt {attempt+1}): {e}")
+                    await asyncio.sleep(delay)
+            else:
+                logger.warning(f"Could not link to node {host}:{port}")
+                return False
+            link = Peer(reader, writer)
+            try:
+                welcome = await asyncio.wait_for(self._dial_handshake(link), HANDSHAKE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Handshake with node {host}:{port} failed: {e}")
+                welcome = None
+            if welcome is None:
+                await link.close()
+                return False
+            node_id = welcome['node_id']
+            if not await self._accept_link(node_id, link, welcome, self.node_id < node_id):
+                await link.close()
+                return False
+            await self._serve_link(node_id, link)
+            return True
+        finally:
+            self._dialing.discard(key)
+
+    async def _dial_handshake(self, link: Peer) -> Optional[dict]:
+        """Answer the other node's challenge and check its proof; returns its welcome."""
+        challenge = await link.receive()
+        if not challenge or challenge.get('type') != 'node_challenge':
+            return None
+        nonce = secrets.token_hex(16)
+        hello = self._hello('node_hello')
+        hello['nonce'] = nonce
+        hello['auth'] = _auth(self.secret, str(challenge.get('nonce')), self.node_id)
+        await link.send(hello)
+        welcome = await link.receive()
+        if not welcome or welcome.get('type') != 'node_welcome':
+            return None
+        if not self._verify(welcome, nonce):
+            logger.warning(f"Node {welcome.get('node_id')} failed authentication")
+            return None
+        return welcome
+
+    async def handle_node_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Authenticate a node dialling our cluster port and serve the link."""
+        link = Peer(reader, writer)
+        nonce = secrets.token_hex(16)
+        try:
+            await link.send({'type': 'node_challenge', 'nonce': nonce})
+            hello = await asyncio.wait_for(link.receive(), HANDSHAKE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Handshake with {writer.get_extra_info('peername')} failed: {e}")
+            await link.close()
+            return
+        if not hello or hello.get('type') != 'node_hello' or not self._verify(hello, nonce):
+            logger.warning(f"Rejected node link from {writer.get_extra_info('peername')}")
+            await link.close()
+            return
+        node_id = hello['node_id']
+        welcome = self._hello('node_welcome')
+        welcome['auth'] = _auth(self.secret, str(hello.get('nonce')), self.node_id)
+        await link.send(welcome)
+        if not await self._accept_link(node_id, link, hello, node_id < self.node_id):
+            await link.close()
+            return
+        await self._serve_link(node_id, link)
+
+    def _verify(self, message: dict, nonce: str) -> bool:
+        node_id = message.get('node_id')
+        if not isinstance(node_id, str) or not node_id or '/' in node_id or node_id == self.node_id:
+            return False
+        return hmac.compare_digest(str(message.get('auth', '')), _auth(self.secret, nonce, node_id))
+
+    async def _serve_link(self, node_id: str, link: Peer):
+        try:
+            while True:
+                message = await link.receive()
+                if not message:
+                    break
+                await self.handle_node_message(node_id, message)
+        except Exception as e:
+            logger.error(f"Error on link to node {node_id}: {e}")
+        finally:
+            await self._remove_node(node_id, link)
+
+    async def _accept_link(self, node_id: str, link: Peer, hello: dict, canonical: bool) -> bool:
+        """
+        Adopt a link to node_id unless a better one exists. When two nodes dial
+        each other at once, the link dialled by the smaller node ID wins on both
+        sides; the other one is only used while it is the sole link.
+        """
+        existing = self.nodes.get(node_id)
+        if existing is not None and not canonical:
+            return False
+        self.nodes[node_id] = link
+        if existing is not None:
+            await existing.close()
+        await self._add_node(node_id, link, hello)
+        return True
+
+    async def _add_node(self, node_id: str, link: Peer, hello: dict):
+        addr = list(hello['addr'])
+        if not addr[0]:
+            # The node listens on a wildcard address; reach it where the link comes from
+            addr[0] = link.addr[0]
+        self.node_addrs[node_id] = addr
+        for peer_id, owner, addr, tags in hello.get('directory', []):
+            if self._owns(node_id, peer_id, owner):
+                self._set_entry(peer_id, owner, addr, tags)
+        logger.info(f"Node {self.node_id} linked with node {node_id} at {addr}")
+        # Complete the mesh with nodes we have not met yet
+        for other_id, addr in hello.get('nodes', []):
+            if other_id != self.node_id and other_id not in self.nodes:
+                asyncio.create_task(self.link_to(addr[0], addr[1]))
+
+    async def _remove_node(self, node_id: str, link: Peer):
+        if self.nodes.get(node_id) is not link:
+            return
+        del self.nodes[node_id]
+        addr = self.node_addrs.pop(node_id, None)
+        for peer_id in [p for p, (owner, _) in self.directory.items() if owner == node_id]:
+            self._drop_entry(peer_id)
+        await link.close()
+        logger.info(f"Node {node_id} left the cluster")
+        if addr is not None and not self._stopped and node_id not in self._redials:
+            self._redials[node_id] = asyncio.create_task(self._redial(node_id, addr))
+
+    async def _redial(self, node_id: str, addr: list):
+        """Re-link a lost node with exponential backoff until a link to it exists again."""
+        delay = REDIAL_MIN_DELAY
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                if node_id in self.nodes:
+                    # The node dialled us back
+                    return
+                if await self.link_to(addr[0], addr[1], retries=1):
+                    # The new link was served until it dropped as well
+                    delay = REDIAL_MIN_DELAY
+                else:
+                    delay = min(delay * 2, REDIAL_MAX_DELAY)
+        finally:
+            self._redials.pop(node_id, None)
+
+    def _owns(self, node_id: str, peer_id, owner) -> bool:
+        """A node may only publish entries it owns, under its own ID namespace."""
+        if owner != node_id or not isinstance(peer_id, str) or not peer_id.startswith(f"{node_id}/"):
+            logger.warning(f"Ignoring directory entry {peer_id!r} (owner {owner!r}) from node {node_id}")
+            return False
+        return True
+
+    async def handle_node_message(self, node_id: str, message: dict):
+        """Handle directory updates and forwarded messages from another node."""
+        msg_type = message.get('type')
+        if msg_type == 'dir_update':
+            peer_id = message.get('peer_id')
+            if not self._owns(node_id, peer_id, message.get('node_id')):
+                return
+            if message.get('op') == 'add':
+                self._set_entry(peer_id, node_id, message['addr'], message.get('tags', {}))
+            elif self.directory.get(peer_id, (None,))[0] == node_id:
+                self._drop_entry(peer_id)
+        elif msg_type == 'forward':
+            target_id = message.get('target_id')
+            if target_id in self.peers:
+                await self.peers[target_id].send(message['message'])
+
+    def _set_entry(self, peer_id: str, owner: str, addr: list, tags: dict):
+        self.directory[peer_id] = (owner, addr)
+        self.tag_index.add(peer_id, tags)
+        self._membership_changed()
+
+    def _drop_entry(self, peer_id: str):
+        self.directory.pop(peer_id, None)
+        self.tag_index.remove(peer_id)
+        self._membership_changed()
+
+    async def _broadcast(self, message: dict):
+        await self.serializer.fan_out(list(self.nodes.values()), message)
+
+    async def handle_register(self, peer_id: str, message: dict):
+        await super().handle_register(peer_id, message)
+        if peer_id not in self.tag_index:
+            # Registration was rejected
+            return
+        addr = list(self.peers[peer_id].public_addr)
+        tags = self.tag_index.tags[peer_id]
+        self.directory[peer_id] = (self.node_id, addr)
+        self._membership_changed()
+        await self._broadcast({'type': 'dir_update', 'op': 'add', 'peer_id': peer_id,
+                               'node_id': self.node_id, 'addr': addr, 'tags': tags})
+
+    async def remove_peer(self, peer_id: str):
+        owned = self.directory.get(peer_id, (None,))[0] == self.node_id
+        await super().remove_peer(peer_id)
+        if owned:
+            self._drop_entry(peer_id)
+            await self._broadcast({'type': 'dir_update', 'op': 'remove', 'peer_id': peer_id,
+                                   'node_id': self.node_id})
+
+    def has_peer(self, peer_id: str) -> bool:
+        return peer_id in self.directory
+
+    def get_peer_addr(self, peer_id: str):
+        return self.directory[peer_id][1]
+
+    async def send_to_peer(self, peer_id: str, message: dict):
+        owner = self.directory[peer_id][0]
+        if owner == self.node_id:
+            await self.peers[peer_id].send(message)
+            return
+        link = self.nodes.get(owner)
+        if link is None:
+            logger.warning(f"No link to node {owner} owning peer {peer_id}")
+            return
+        await link.send({'type': 'forward', 'target_id': peer_id, 'message': message})
+
+    async def handle_list_peers(self, peer_id: str):
+        """Send the IDs of all peers registered anywhere in the cluster."""
+        frame = await self._peer_list_frame(lambda: list(self.directory.keys()))
+        await self.peers[peer_id].send_frame(frame)
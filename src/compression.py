@@ -0,0 +1,301 @@
+"""
+This module contains adaptive zlib stream compression for relayed traffic.
+
+A compressed relay stream starts with a one line JSON handshake in which the
+connecting side proposes a zlib level and the accepting side caps it at its
+own maximum. After that every chunk is sent as a frame: a one byte flag
+(raw or zlib), a four byte big-endian length and the payload.
+
+A handover frame carries the number of payload bytes sent so far on the
+current path; the sender continues on a new path right after it and the
+receiver switches over once it has read exactly that many bytes, so a stream
+can move between connections without losing or duplicating data.
+"""
+import asyncio
+import json
+import logging
+import struct
+import time
+import zlib
+from concurrent.futures import Executor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+FRAME_RAW = 0
+FRAME_ZLIB = 1
+FRAME_HANDOVER = 2
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+DEFAULT_OFFLOAD_THRESHOLD = 16 * 1024
+MAX_LEVEL = 9
+# Seconds to wait for the other side's handshake line
+HANDSHAKE_TIMEOUT = 10.0
+
+_HEADER = struct.Struct('!BI')
+_SEQ = struct.Struct('!Q')
+
+
+class CompressionStats:
+    """Per-stream compression ratio and CPU time counters."""
+
+    def __init__(self):
+        self.raw_bytes_out = 0
+        self.wire_bytes_out = 0
+        self.wire_bytes_in = 0
+        self.raw_bytes_in = 0
+        self.frames_compressed = 0
+        self.frames_raw = 0
+        self.compress_cpu = 0.0
+        self.decompress_cpu = 0.0
+        self.disabled_count = 0
+
+    @property
+    def ratio(self) -> float:
+        """Outbound wire bytes divided by outbound payload bytes (1.0 means no saving)."""
+        if not self.raw_bytes_out:
+            return 1.0
+        return self.wire_bytes_out / self.raw_bytes_out
+
+    def as_dict(self) -> dict:
+        return {
+            'raw_bytes_out': self.raw_bytes_out,
+            'wire_bytes_out': self.wire_bytes_out,
+            'raw_bytes_in': self.raw_bytes_in,
+            'wire_bytes_in': self.wire_bytes_in,
+            'frames_compressed': self.frames_compressed,
+            'frames_raw': self.frames_raw,
+            'ratio': round(self.ratio, 3),
+            'compress_cpu': round(self.compress_cpu, 6),
+            'decompress_cpu': round(self.decompress_cpu, 6),
+            'disabled_count': self.disabled_count,
+        }
+
+
+def _compress(data: bytes, level: int):
+    start = time.thread_time()
+    out = zlib.compress(data, level)
+    return out, time.thread_time() - start
+
+
+def _decompress(data: bytes):
+    start = time.thread_time()
+    decompressor = zlib.decompressobj()
+    out = decompressor.decompress(data, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed frame exceeds maximum frame size")
+    return out, time.thread_time() - start
+
+
+async def _run(executor: Optional[Executor], offload: bool, func, *args):
+    """Run func inline, or in the executor when the chunk is large enough."""
+    if offload:
+        return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+    return func(*args)
+
+
+class CompressedWriter:
+    """
+    Wraps a StreamWriter and sends framed, adaptively compressed chunks.
+
+    Mirrors the write()/drain()/close()/wait_closed() interface so it can be
+    used wherever the relay expects a StreamWriter. Compression is switched
+    off when a sample window compresses worse than ``disable_ratio`` and is
+    probed again after ``probe_interval`` raw frames.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, level: int, stats: CompressionStats,
+                 executor: Optional[Executor] = None,
+                 offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD,
+                 disable_ratio: float = 0.9, sample_bytes: int = 64 * 1024,
+                 probe_interval: int = 256):
+        self.writer = writer
+        self.level = level
+        self.stats = stats
+        self.executor = executor
+        self.offload_threshold = offload_threshold
+        self.disable_ratio = disable_ratio
+        self.sample_bytes = sample_bytes
+        self.probe_interval = probe_interval
+        self.enabled = True
+        self.seq_out = 0
+        self._pending = []
+        self._sample_raw = 0
+        self._sample_wire = 0
+        self._raw_since_disable = 0
+
+    def write(self, data: bytes):
+        if data:
+            self._pending.append(data)
+
+    async def drain(self):
+        while self._pending:
+            await self._send_frame(self._pending.pop(0))
+        await self.writer.drain()
+
+    async def _send_frame(self, data: bytes):
+        self.stats.raw_bytes_out += len(data)
+        if not self.enabled:
+            self._raw_since_disable += 1
+            if self._raw_since_disable >= self.probe_interval:
+                # Payloads may have become compressible again; sample one more window
+                self.enabled = True
+            self._write_frame(FRAME_RAW, data, len(data))
+            return
+
+        offload = len(data) >= self.offload_threshold
+        compressed, cpu = await _run(self.executor, offload, _compress, data, self.level)
+        self.stats.compress_cpu += cpu
+        self._sample_raw += len(data)
+        self._sample_wire += min(len(compressed), len(data))
+        if len(compressed) < len(data):
+            self._write_frame(FRAME_ZLIB, compressed, len(data))
+        else:
+            self._write_frame(FRAME_RAW, data, len(data))
+
+        if self._sample_raw >= self.sample_bytes:
+            if self._sample_wire / self._sample_raw > self.disable_ratio:
+                self.enabled = False
+                self._raw_since_disable = 0
+                self.stats.disabled_count += 1
+                logger.info(f"Disabling compression, sampled ratio {self._sample_wire / self._sample_raw:.2f}")
+            self._sample_raw = 0
+            self._sample_wire = 0
+
+    def _write_frame(self, flag: int, payload: bytes, raw_len: int):
+        if flag == FRAME_ZLIB:
+            self.stats.frames_compressed += 1
+        else:
+            self.stats.frames_raw += 1
+        self.stats.wire_bytes_out += _HEADER.size + len(payload)
+        self.seq_out += raw_len
+        self.writer.write(_HEADER.pack(flag, len(payload)) + payload)
+
+    async def switch(self, new_writer: asyncio.StreamWriter):
+        """
+        Mark the end of the current path with a handover frame and send all
+        further frames on new_writer. Returns the old writer, still open.
+        """
+        old_writer = self.writer
+        old_writer.write(_HEADER.pack(FRAME_HANDOVER, _SEQ.size) + _SEQ.pack(self.seq_out))
+        self.writer = new_writer
+        await old_writer.drain()
+        return old_writer
+
+    def close(self):
+        self.writer.close()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+
+class CompressedReader:
+    """Wraps a StreamReader and yields the decoded payload of one frame per read()."""
+
+    def __init__(self, reader: asyncio.StreamReader, stats: CompressionStats,
+                 executor: Optional[Executor] = None,
+                 offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD):
+        self.reader = reader
+        self.stats = stats
+        self.executor = executor
+        self.offload_threshold = offload_threshold
+        self.seq_in = 0
+        self.switched = asyncio.Event()
+        self._next_reader: Optional[asyncio.Future] = None
+
+    def attach(self, new_reader: asyncio.StreamReader):
+        """Provide the path to continue on once the peer's handover frame arrives."""
+        self._get_next_reader().set_result(new_reader)
+
+    def _get_next_reader(self) -> asyncio.Future:
+        if self._next_reader is None:
+            self._next_reader = asyncio.get_event_loop().create_future()
+        return self._next_reader
+
+    async def read(self, n: int = -1) -> bytes:
+        """Return the next frame's payload, or b'' at end of stream. ``n`` is ignored."""
+        while True:
+            payload = await self._read_frame()
+            if payload is not None:
+                return payload
+
+    async def _handover(self, payload: bytes):
+        (seq,) = _SEQ.unpack(payload)
+        if seq != self.seq_in:
+            raise ValueError(f"Handover at byte {seq} but {self.seq_in} bytes received")
+        self.reader = await self._get_next_reader()
+        self._next_reader = None
+        self.switched.set()
+
+    async def _read_frame(self) -> Optional[bytes]:
+        try:
+            header = await self.reader.readexactly(_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ValueError("Truncated frame header")
+            return b''
+        flag, length = _HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds maximum frame size")
+        payload = await self.reader.readexactly(length)
+        self.stats.wire_bytes_in += _HEADER.size + length
+        if flag == FRAME_HANDOVER:
+            await self._handover(payload)
+            return None
+        if flag == FRAME_ZLIB:
+            offload = length >= self.offload_threshold
+            payload, cpu = await _run(self.executor, offload, _decompress, payload)
+            self.stats.decompress_cpu += cpu
+        elif flag != FRAME_RAW:
+            raise ValueError(f"Unknown frame type {flag}")
+        self.stats.raw_bytes_in += len(payload)
+        self.seq_in += len(payload)
+        return payload
+
+
+async def _read_handshake_line(reader: asyncio.StreamReader, timeout: float) -> bytes:
+    try:
+        return await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        raise ConnectionError(f"No compression handshake within {timeout}s (is the other side compressing?)")
+
+
+async def negotiate_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, level: int,
+                           timeout: float = HANDSHAKE_TIMEOUT) -> dict:
+    """Propose a compression level to the accepting relay and return its compress_ack."""
+    writer.write(json.dumps({'type': 'compress_hello', 'level': level}).encode() + b'\n')
+    await writer.drain()
+    data = await _read_handshake_line(reader, timeout)
+    if not data:
+        raise ConnectionError("Relay closed connection during compression negotiation")
+    response = json.loads(data.decode())
+    if response.get('type') != 'compress_ack':
+        raise ValueError(f"Unexpected negotiation reply: {response}")
+    response['level'] = max(0, min(int(response.get('level', 0)), MAX_LEVEL))
+    return response
+
+
+async def read_hello(reader: asyncio.StreamReader, timeout: float = HANDSHAKE_TIMEOUT) -> dict:
+    """Read the first handshake line sent by the connecting relay."""
+    data = await _read_handshake_line(reader, timeout)
+    if not data:
+        raise ConnectionError("Peer closed connection during compression negotiation")
+    return json.loads(data.decode())
+
+
+async def negotiate_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_level: int,
+                           hello: Optional[dict] = None, offer: Optional[dict] = None) -> int:
+    """
+    Answer a compression proposal, capping it at max_level and at zlib's
+    maximum of 9, and return the agreed level. hello is the already-read
+    proposal, if any; offer holds extra fields to include in the compress_ack.
+    """
+    message = hello if hello is not None else await read_hello(reader)
+    if message.get('type') != 'compress_hello':
+        raise ValueError(f"Unexpected negotiation message: {message}")
+    level = max(0, min(int(message.get('level', 0)), max_level, MAX_LEVEL))
+    ack = {'type': 'compress_ack', 'level': level}
+    if offer:
+        ack.update(offer)
+    writer.write(json.dumps(ack).encode() + b'\n')
+    await writer.drain()
+    return level
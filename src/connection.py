@@ -0,0 +1,119 @@
+"""
+This module contains the headless peer connection handle and a pool that reuses live links.
+"""
+import asyncio
+import logging
+import socket
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class PeerConnection:
+    """
+    A direct link to another peer established through hole punching.
+
+    Data is exchanged through the asyncio reader/writer pair of the punched
+    connection.
+    """
+
+    def __init__(self, peer_id: str, addr: Tuple[str, int],
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peer_id = peer_id
+        self.addr = tuple(addr)
+        self.reader = reader
+        self.writer = writer
+        self.created_at = time.monotonic()
+        self._closed = False
+
+    @property
+    def sock(self) -> Optional[socket.socket]:
+        return self.writer.get_extra_info('socket')
+
+    def is_alive(self) -> bool:
+        """Return True while the link is open and the peer has not closed it."""
+        return not (self._closed or self.writer.is_closing() or self.reader.at_eof())
+
+    async def send(self, data: bytes):
+        """Write data to the peer and wait until it is flushed."""
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def recv(self, n: int = 65536) -> bytes:
+        """Read up to n bytes from the peer; returns b'' once the peer has closed the link."""
+        return await self.reader.read(n)
+
+    def close(self):
+        """Close the link."""
+        if self._closed:
+            return
+        self._closed = True
+        self.writer.close()
+
+    async def wait_closed(self):
+        """Close the link and wait until the transport is closed."""
+        self.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f"PeerConnection(peer_id={self.peer_id!r}, addr={self.addr!r}, alive={self.is_alive()})"
+
+
+class PeerConnectionPool:
+    """
+    Reuses live PeerConnections obtained from a headless Client.
+
+    Concurrent get() calls for the same peer share a single in-flight connect.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.connections: Dict[str, PeerConnection] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get(self, peer_id: str, timeout: Optional[float] = None) -> PeerConnection:
+        """Return a live connection to peer_id, connecting if needed."""
+        conn = self.connections.get(peer_id)
+        if conn is not None and conn.is_alive():
+            return conn
+        self.connections.pop(peer_id, None)
+
+        inflight = self._inflight.get(peer_id)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        fut = asyncio.get_event_loop().create_future()
+        self._inflight[peer_id] = fut
+        try:
+            conn = await self.client.connect(peer_id, timeout=timeout)
+            self.connections[peer_id] = conn
+            fut.set_result(conn)
+            return conn
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # Mark retrieved so an unawaited failure is not reported as never retrieved
+            fut.exception()
+            raise
+        finally:
+            del self._inflight[peer_id]
+
+    def add(self, conn: PeerConnection):
+        """Adopt a connection established by the remote side."""
+        self.connections[conn.peer_id] = conn
+
+    def discard(self, peer_id: str):
+        """Close and forget the connection to peer_id."""
+        conn = self.connections.pop(peer_id, None)
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        """Close every pooled connection."""
+        for peer_id in list(self.connections):
+            self.discard(peer_id)
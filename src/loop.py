@@ -0,0 +1,36 @@
+"""
+This module selects the event-loop implementation before asyncio.run().
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOOP_CHOICES = ('auto', 'asyncio', 'uvloop')
+
+
+def add_loop_argument(parser):
+    """Register the --loop option on a command-line parser."""
+    parser.add_argument("--loop", choices=LOOP_CHOICES, default="asyncio",
+                        help="Event loop implementation (auto uses uvloop when it is installed)")
+
+
+def install_event_loop(name: str = 'asyncio') -> str:
+    """
+    Install the event-loop policy for name and return the implementation in use.
+    'uvloop' fails if uvloop is not installed; 'auto' falls back to asyncio.
+    """
+    if name not in LOOP_CHOICES:
+        raise ValueError(f"Unknown event loop: {name}")
+    if name == 'asyncio':
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.debug("Using uvloop event loop")
+    return 'uvloop'
@@ -1,13 +1,14 @@
-from src.server import Server
-from src.client import Client
+from src.loop import add_loop_argument, install_event_loop
+from src.profiling import ProfilingMode, add_profile_arguments
 import argparse
 import asyncio
 import logging
+import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def main():
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="P2P Network Application")
     parser.add_argument("--mode", choices=["server", "client", "client-app"], required=True,
                        help="Run as server, client, or client-app")
@@ -25,35 +26,93 @@ async def main():
                        help="Relay target host (for relay request)")
     parser.add_argument("--relay-target-port", type=int, default=None,
                        help="Relay target port (for relay request)")
+    parser.add_argument("--relay-compress", type=int, default=None, metavar="LEVEL", choices=range(10),
+                       help="Enable zlib stream compression between relays (server: max level accepted, client-app: level proposed)")
+    parser.add_argument("--relay-migrate", action="store_true",
+                       help="Move relayed streams onto a direct punched path when one can be established "
+                            "(client-app only; run the far relay with src.tcp_relay --migrate)")
+    parser.add_argument("--tag", action="append", default=[], metavar="KEY=VALUE",
+                       help="Metadata tag to register with (client only, repeatable)")
+    parser.add_argument("--node-id", type=str, default=None,
+                       help="Cluster node ID (server only; enables cluster mode)")
+    parser.add_argument("--cluster-seed", action="append", default=[], metavar="HOST:PORT",
+                       help="Cluster address of another rendezvous node to join (server only, repeatable; enables cluster mode)")
+    parser.add_argument("--cluster-host", type=str, default=None,
+                       help="Host for node-to-node links (server only, default: --host; keep it off the public interface)")
+    parser.add_argument("--cluster-port", type=int, default=None,
+                       help="Port for node-to-node links (server only, default: --port + 1)")
+    parser.add_argument("--cluster-advertise-host", type=str, default=None,
+                       help="Address other nodes use to reach the cluster port (server only, default: --cluster-host, "
+                            "or the link's source address when it is a wildcard)")
+    parser.add_argument("--cluster-secret", type=str, default=os.environ.get("P2P_CLUSTER_SECRET"),
+                       help="Shared secret authenticating cluster nodes (default: $P2P_CLUSTER_SECRET)")
+    add_profile_arguments(parser)
+    add_loop_argument(parser)
+    return parser
 
-    args = parser.parse_args()
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.mode == "server" and args.relay_migrate:
+        # The server-side relay sits on the rendezvous host, so a direct path gains nothing
+        parser.error("--relay-migrate is not supported in server mode")
+    return args
+
+async def main(args: argparse.Namespace = None):
+    if args is None:
+        args = parse_args()
+
+    profiling = ProfilingMode.from_args(args)
+    if profiling:
+        profiling.install()
 
     try:
         if args.mode == "server":
             # Optionally start relay if relay args are provided
             if args.relay_port and args.relay_target_host and args.relay_target_port:
                 from src.tcp_relay import TCPRelayServer
-                relay = TCPRelayServer(args.host, args.relay_port, args.relay_target_host, args.relay_target_port)
+                relay = TCPRelayServer(args.host, args.relay_port, args.relay_target_host, args.relay_target_port,
+                                       compress_level=args.relay_compress,
+                                       compress_side='client' if args.relay_compress else None)
                 asyncio.create_task(relay.start())
                 logger.info(f"Started TCP relay on {args.host}:{args.relay_port} -> {args.relay_target_host}:{args.relay_target_port}")
-            server = Server(args.host, args.port)
+            if args.node_id or args.cluster_seed:
+                from src.cluster import ClusterServer
+                seeds = [(seed.rsplit(":", 1)[0], int(seed.rsplit(":", 1)[1])) for seed in args.cluster_seed]
+                cluster_port = args.cluster_port if args.cluster_port is not None else args.port + 1
+                server = ClusterServer(args.host, args.port, node_id=args.node_id, seeds=seeds,
+                                       secret=args.cluster_secret, cluster_host=args.cluster_host,
+                                       cluster_port=cluster_port, advertise_host=args.cluster_advertise_host)
+            else:
+                from src.server import Server
+                server = Server(args.host, args.port)
             await server.start()
         else:
             from src.client import Client
+            tags = dict(tag.split("=", 1) for tag in args.tag if "=" in tag)
             # If client-app mode, pass relay args
             if args.mode == "client-app":
                 client = Client(args.server_host, args.server_port)
                 client.relay_port = args.relay_port
                 client.relay_target_host = args.relay_target_host
                 client.relay_target_port = args.relay_target_port
+                client.relay_compress_level = args.relay_compress
+                client.relay_migrate = args.relay_migrate
+                client.tags = tags
                 await client.start()
             else:
                 client = Client(args.server_host, args.server_port)
+                client.tags = tags
                 await client.start()
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
         logger.error(f"Error: {e}")
+    finally:
+        if profiling:
+            profiling.uninstall()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    install_event_loop(args.loop)
+    asyncio.run(main(args))
@@ -1,6 +1,7 @@
 """
 This module contains utilities for NAT traversal and hole punching.
 """
+import errno
 import socket
 import asyncio
 import logging
@@ -8,54 +9,163 @@ from typing import Tuple, Optional, Callable
 
 logger = logging.getLogger(__name__)
 
+# Seconds to keep listening after a refused outgoing punch before dialing again
+RETRY_DELAY = 0.5
+
 class _TCPPunchProtocol(asyncio.Protocol):
-    def __init__(self, on_connection: Callable):
+    """Reports accepted connections and delegates everything else to the wrapped protocol."""
+    def __init__(self, on_connection: Callable, protocol: asyncio.Protocol):
         self.on_connection = on_connection
+        self.protocol = protocol
     def connection_made(self, transport):
+        self.protocol.connection_made(transport)
         self.on_connection(transport)
+    def data_received(self, data):
+        self.protocol.data_received(data)
+    def eof_received(self):
+        return self.protocol.eof_received()
+    def connection_lost(self, exc):
+        self.protocol.connection_lost(exc)
+    def pause_writing(self):
+        self.protocol.pause_writing()
+    def resume_writing(self):
+        self.protocol.resume_writing()
 
-async def tcp_hole_punch(local_host: str, local_port: int, target_host: str, target_port: int, timeout: float = 15.0, retries: int = 10) -> Optional[socket.socket]:
+async def _connect_from_port(protocol_factory: Callable, local_host: str, local_port: int,
+                             target_host: str, target_port: int):
     """
-    Attempt TCP hole punching by simultaneously listening and connecting.
-    Returns the established socket if successful, else None.
+    Connect from the shared local port so the outgoing attempt uses the punched
+    mapping. Falls back to an ephemeral port if that 4-tuple is still taken
+    (e.g. a previous link to the same target is in TIME_WAIT).
+    """
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind((local_host, local_port))
+        await loop.sock_connect(sock, (target_host, target_port))
+    except (OSError, asyncio.CancelledError) as e:
+        sock.close()
+        if isinstance(e, OSError) and e.errno in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+            logger.debug(f"Local port {local_port} unavailable for {target_host}:{target_port}, using ephemeral port")
+            return await loop.create_connection(protocol_factory, target_host, target_port)
+        raise
+    return await loop.create_connection(protocol_factory, sock=sock)
+
+async def _tcp_hole_punch(local_host: str, local_port: int, target_host: str, target_port: int,
+                          timeout: float, retries: int, reuse_port: bool, protocol_factory: Callable):
+    """
+    Shared simultaneous listen/connect loop. Returns the (transport, protocol)
+    pair of the first connection established, else None.
+
+    The listener stays open for all attempts. An outgoing attempt that fails
+    (typically refused because the peer is not listening yet) counts as a
+    failed attempt: we keep listening for RETRY_DELAY and then dial again.
     """
     loop = asyncio.get_event_loop()
     incoming_fut = loop.create_future()
 
-    def on_incoming(transport):
-        if not incoming_fut.done():
-            incoming_fut.set_result(transport)
+    def on_incoming(transport, protocol):
+        if incoming_fut.done():
+            # We already have a link to the peer
+            transport.close()
+        else:
+            incoming_fut.set_result((transport, protocol))
 
-    for attempt in range(retries):
-        server = await loop.create_server(lambda: _TCPPunchProtocol(on_incoming), local_host, local_port)
-        try:
+    def incoming_factory():
+        protocol = protocol_factory()
+        return _TCPPunchProtocol(lambda transport: on_incoming(transport, protocol), protocol)
+
+    server = await loop.create_server(incoming_factory, local_host, local_port,
+                                      reuse_port=reuse_port or None)
+    outgoing_task = None
+    try:
+        for attempt in range(retries):
             # Start outgoing connection attempt
-            outgoing_task = loop.create_task(loop.create_connection(asyncio.Protocol, target_host, target_port))
+            if reuse_port:
+                outgoing = _connect_from_port(protocol_factory, local_host, local_port, target_host, target_port)
+            else:
+                outgoing = loop.create_connection(protocol_factory, target_host, target_port)
+            outgoing_task = loop.create_task(outgoing)
             # Wait for either incoming or outgoing connection
-            done, pending = await asyncio.wait(
-                [incoming_fut, outgoing_task],
-                timeout=timeout,
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            sock = None
-            if incoming_fut in done and incoming_fut.done():
-                transport = incoming_fut.result()
-                sock = transport.get_extra_info('socket')
-            elif outgoing_task in done and outgoing_task.done():
-                transport, _ = outgoing_task.result()
-                sock = transport.get_extra_info('socket')
-            for task in pending:
-                task.cancel()
-            if sock:
+            await asyncio.wait([incoming_fut, outgoing_task], timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not outgoing_task.done():
+                outgoing_task.cancel()
+            elif outgoing_task.exception() is not None:
+                logger.debug(f"Outgoing punch to {target_host}:{target_port} failed: {outgoing_task.exception()}")
+                if not incoming_fut.done():
+                    await asyncio.wait([incoming_fut], timeout=RETRY_DELAY)
+
+            result = None
+            if incoming_fut.done():
+                result = incoming_fut.result()
+                if outgoing_task.done() and not outgoing_task.cancelled() and outgoing_task.exception() is None:
+                    # Both directions connected; keep the incoming one
+                    outgoing_task.result()[0].close()
+            elif outgoing_task.done() and not outgoing_task.cancelled() and outgoing_task.exception() is None:
+                result = outgoing_task.result()
+                incoming_fut.cancel()
+            if result:
+                sock = result[0].get_extra_info('socket')
                 logger.info(f"TCP hole punch successful: {sock.getsockname()} <-> {sock.getpeername()} (attempt {attempt+1})")
-                return sock
+                return result
             logger.warning(f"TCP hole punch attempt {attempt+1} failed")
-        finally:
-            server.close()
-            await server.wait_closed()
+    except asyncio.CancelledError:
+        # The caller gave up (e.g. its deadline passed); close any link made meanwhile
+        for fut in (outgoing_task, incoming_fut):
+            if fut is None:
+                continue
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                fut.result()[0].close()
+            fut.cancel()
+        raise
+    finally:
+        server.close()
+        await server.wait_closed()
+    incoming_fut.cancel()
     logger.warning("TCP hole punch failed after all retries")
     return None
 
+async def tcp_hole_punch(local_host: str, local_port: int, target_host: str, target_port: int, timeout: float = 15.0, retries: int = 10, reuse_port: bool = False) -> Optional[socket.socket]:
+    """
+    Attempt TCP hole punching by simultaneously listening and connecting.
+    Returns the established socket if successful, else None.
+    Set reuse_port when local_port is shared with other sockets (the server
+    connection or concurrent punches); those sockets need SO_REUSEPORT too.
+    """
+    result = await _tcp_hole_punch(local_host, local_port, target_host, target_port,
+                                   timeout, retries, reuse_port, asyncio.Protocol)
+    if result is None:
+        return None
+    return result[0].get_extra_info('socket')
+
+async def tcp_hole_punch_stream(local_host: str, local_port: int, target_host: str, target_port: int, timeout: float = 15.0, retries: int = 10, reuse_port: bool = False) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """
+    Like tcp_hole_punch, but returns a (reader, writer) stream pair so the
+    punched connection can carry data. Returns None if punching fails.
+    """
+    loop = asyncio.get_event_loop()
+    # StreamReaderProtocol only keeps a weak reference to its reader
+    readers = {}
+
+    def factory():
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        readers[protocol] = reader
+        return protocol
+
+    result = await _tcp_hole_punch(local_host, local_port, target_host, target_port,
+                                   timeout, retries, reuse_port, factory)
+    if result is None:
+        return None
+    transport, protocol = result
+    reader = readers[protocol]
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
 async def create_punch_socket(host: str, port: int = 0) -> Tuple[socket.socket, int]:
     """
     Create a socket for NAT traversal and bind it to the specified host and port.
@@ -1,6 +1,7 @@
 import asyncio
 import json
 from typing import Optional
+from .serialization import encode_frame
 
 class Peer:
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -12,8 +13,15 @@ class Peer:
     async def send(self, message: dict):
         """Send a message to the peer."""
         try:
-            data = json.dumps(message).encode() + b'\n'
-            self.writer.write(data)
+            data = encode_frame(message)
+        except Exception as e:
+            raise Exception(f"Failed to send message: {e}")
+        await self.send_frame(data)
+
+    async def send_frame(self, frame: bytes):
+        """Send an already encoded frame (see src.serialization) to the peer."""
+        try:
+            self.writer.write(frame)
             await self.writer.drain()
         except Exception as e:
             raise Exception(f"Failed to send message: {e}")
@@ -0,0 +1,210 @@
+"""
+This module contains the secondary index over peer metadata tags.
+"""
+import bisect
+from typing import Dict, Iterator, List, Optional, Tuple
+
+MAX_TAGS = 32
+MAX_TAG_LENGTH = 128
+MAX_QUERY_LIMIT = 1000
+
+
+def validate_tags(tags) -> Dict[str, str]:
+    """Return tags as a str -> str dict, raising ValueError if they are malformed."""
+    if tags is None:
+        return {}
+    if not isinstance(tags, dict):
+        raise ValueError("tags must be an object")
+    if len(tags) > MAX_TAGS:
+        raise ValueError(f"at most {MAX_TAGS} tags are allowed")
+    clean = {}
+    for key, value in tags.items():
+        if not isinstance(value, (str, int, float, bool)):
+            raise ValueError(f"tag {key!r} must have a scalar value")
+        key, value = str(key), str(value)
+        if len(key) > MAX_TAG_LENGTH or len(value) > MAX_TAG_LENGTH:
+            raise ValueError(f"tag {key[:MAX_TAG_LENGTH]!r} is too long")
+        clean[key] = value
+    return clean
+
+
+class _SortedIds:
+    """
+    Sorted set of peer IDs stored as a list of bounded sorted chunks, so an
+    insert or delete only shifts one chunk instead of the whole list.
+    """
+
+    CHUNK = 512
+
+    def __init__(self):
+        self._chunks: List[List[str]] = []
+        # Last (largest) ID of each chunk
+        self._maxes: List[str] = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, peer_id: str) -> bool:
+        i = bisect.bisect_left(self._maxes, peer_id)
+        if i == len(self._maxes):
+            return False
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, peer_id)
+        return chunk[j] == peer_id
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self._chunks:
+            yield from chunk
+
+    def add(self, peer_id: str):
+        if not self._chunks:
+            self._chunks.append([peer_id])
+            self._maxes.append(peer_id)
+            self._len = 1
+            return
+        i = min(bisect.bisect_left(self._maxes, peer_id), len(self._maxes) - 1)
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, peer_id)
+        if j < len(chunk) and chunk[j] == peer_id:
+            return
+        chunk.insert(j, peer_id)
+        self._maxes[i] = chunk[-1]
+        self._len += 1
+        if len(chunk) > 2 * self.CHUNK:
+            self._chunks[i:i + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+            self._maxes[i:i + 1] = [chunk[self.CHUNK - 1], chunk[-1]]
+
+    def discard(self, peer_id: str):
+        i = bisect.bisect_left(self._maxes, peer_id)
+        if i == len(self._maxes):
+            return
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, peer_id)
+        if chunk[j] != peer_id:
+            return
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def ceiling(self, peer_id: Optional[str], strict: bool = False) -> Optional[str]:
+        """Smallest ID >= peer_id (> peer_id if strict; the first ID if peer_id is None), else None."""
+        if not self._chunks:
+            return None
+        if peer_id is None:
+            return self._chunks[0][0]
+        find = bisect.bisect_right if strict else bisect.bisect_left
+        i = find(self._maxes, peer_id)
+        if i == len(self._maxes):
+            return None
+        chunk = self._chunks[i]
+        return chunk[find(chunk, peer_id)]
+
+    def iter_after(self, peer_id: Optional[str]) -> Iterator[str]:
+        """Iterate the IDs greater than peer_id (all IDs if peer_id is None) in order."""
+        if peer_id is None:
+            yield from self
+            return
+        i = bisect.bisect_right(self._maxes, peer_id)
+        if i == len(self._maxes):
+            return
+        chunk = self._chunks[i]
+        yield from chunk[bisect.bisect_right(chunk, peer_id):]
+        for chunk in self._chunks[i + 1:]:
+            yield from chunk
+
+
+class TagIndex:
+    """
+    Peer tags plus an inverted index (key, value) -> sorted peer IDs.
+
+    A page starts at the cursor with a bisect. With one filter (or none) it
+    then reads the next limit IDs. With several filters the posting lists are
+    intersected by leapfrogging: each list jumps ahead with a bisect to the
+    current candidate, so the cost depends on how the lists interleave, not
+    on their sizes. Inserts and deletes cost O(log n + chunk size).
+    """
+
+    def __init__(self):
+        self.tags: Dict[str, Dict[str, str]] = {}
+        self.index: Dict[Tuple[str, str], _SortedIds] = {}
+        self.peer_ids = _SortedIds()
+
+    def __contains__(self, peer_id: str) -> bool:
+        return peer_id in self.tags
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def add(self, peer_id: str, tags: Dict[str, str]):
+        """Register peer_id with tags, replacing any previous tags."""
+        self.remove(peer_id)
+        self.tags[peer_id] = dict(tags)
+        self.peer_ids.add(peer_id)
+        for item in tags.items():
+            postings = self.index.get(item)
+            if postings is None:
+                postings = self.index[item] = _SortedIds()
+            postings.add(peer_id)
+
+    def remove(self, peer_id: str):
+        tags = self.tags.pop(peer_id, None)
+        if tags is None:
+            return
+        self.peer_ids.discard(peer_id)
+        for item in tags.items():
+            peers = self.index.get(item)
+            if peers is not None:
+                peers.discard(peer_id)
+                if not peers:
+                    del self.index[item]
+
+    def query(self, filters: Optional[Dict[str, str]] = None, limit: int = 100,
+              cursor: Optional[str] = None) -> Tuple[List[Tuple[str, Dict[str, str]]], Optional[str]]:
+        """
+        Return up to limit (peer_id, tags) pairs whose tags contain all of
+        filters, ordered by peer ID and starting after cursor, plus the cursor
+        for the next page (None when there are no more results).
+        """
+        limit = max(1, min(limit, MAX_QUERY_LIMIT))
+        postings = [self.peer_ids]
+        if filters:
+            postings = []
+            for item in filters.items():
+                peers = self.index.get(item)
+                if not peers:
+                    return [], None
+                postings.append(peers)
+            postings.sort(key=len)
+
+        page = []
+        for peer_id in self._matches(postings, cursor):
+            if len(page) == limit:
+                # One more match exists, so there is a next page
+                return page, page[-1][0]
+            page.append((peer_id, self.tags[peer_id]))
+        return page, None
+
+    @staticmethod
+    def _matches(postings: List[_SortedIds], cursor: Optional[str]) -> Iterator[str]:
+        """Yield, in order, the IDs after cursor present in every posting list."""
+        if len(postings) == 1:
+            yield from postings[0].iter_after(cursor)
+            return
+        first, rest = postings[0], postings[1:]
+        candidate = first.ceiling(cursor, strict=True)
+        while candidate is not None:
+            for peers in rest:
+                found = peers.ceiling(candidate)
+                if found is None:
+                    return
+                if found != candidate:
+                    candidate = first.ceiling(found)
+                    break
+            else:
+                yield candidate
+                candidate = first.ceiling(candidate, strict=True)
@@ -0,0 +1,252 @@
+"""
+This module contains the opt-in profiling mode used by --profile.
+
+It times event-loop callbacks to report slow ones, samples event-loop lag, dumps
+running tasks on SIGUSR1 and toggles a profiler on SIGUSR2. The profiler is
+either cProfile (writes .pstats) or a stack sampler (writes collapsed stacks
+suitable for flamegraph tools).
+
+asyncio's debug mode is not used by default: it records a traceback for every
+handle and slows the loop down about tenfold, which would both hurt the
+profiled process and dominate the profiler output.
+"""
+import argparse
+import asyncio
+import collections
+import io
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ('cprofile', 'sampling')
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Register the --profile options on a command-line parser."""
+    parser.add_argument("--profile", action="store_true",
+                        help="Enable profiling mode (slow callbacks, loop lag, SIGUSR1 task dump, SIGUSR2 profiler toggle)")
+    parser.add_argument("--profile-slow-callback", type=float, default=0.1,
+                        help="Log callbacks that block the event loop longer than this many seconds")
+    parser.add_argument("--profile-lag-interval", type=float, default=0.5,
+                        help="Seconds between event-loop lag samples")
+    parser.add_argument("--profile-asyncio-debug", action="store_true",
+                        help="Also enable asyncio debug mode (much slower; reports where slow coroutines were created)")
+    parser.add_argument("--profiler", choices=PROFILERS, default='sampling',
+                        help="Profiler toggled by SIGUSR2")
+    parser.add_argument("--profile-output", type=str, default="profile",
+                        help="Path prefix for profiler output files")
+
+
+class LoopLagMonitor:
+    """Continuously measures how late the event loop wakes up from a sleep."""
+
+    def __init__(self, interval: float = 0.5, warn_threshold: float = 0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.samples = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def mean_lag(self) -> float:
+        return self.total_lag / self.samples if self.samples else 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.samples += 1
+            self.last_lag = lag
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_threshold:
+                logger.warning(f"Event loop lag {lag * 1000:.1f} ms (max {self.max_lag * 1000:.1f} ms)")
+
+
+class SlowCallbackMonitor:
+    """
+    Logs event-loop callbacks that run longer than threshold seconds.
+
+    Wraps asyncio.Handle._run, which costs two clock reads per callback. Loops
+    that do not run callbacks through Handle (uvloop) are not covered; the
+    LoopLagMonitor still reports the lag they cause.
+    """
+
+    def __init__(self, threshold: float = 0.1):
+        self.threshold = threshold
+        self.slow_callbacks = 0
+        self._original = None
+
+    def start(self):
+        if self._original is not None:
+            return
+        original = self._original = asyncio.Handle._run
+        monitor = self
+
+        def _run(handle):
+            start = time.perf_counter()
+            try:
+                return original(handle)
+            finally:
+                duration = time.perf_counter() - start
+                if duration >= monitor.threshold:
+                    monitor.slow_callbacks += 1
+                    logger.warning(f"Executing {handle!r} took {duration:.3f} seconds")
+
+        asyncio.Handle._run = _run
+
+    def stop(self):
+        if self._original is not None:
+            asyncio.Handle._run = self._original
+            self._original = None
+
+
+class StackSampler:
+    """Samples the stack of one thread at a fixed interval and counts collapsed stacks."""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Dict[str, int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.counts[';'.join(reversed(names))] += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def format_tasks() -> str:
+    """Return every running task with its current stack frames."""
+    out = io.StringIO()
+    tasks = asyncio.all_tasks()
+    out.write(f"{len(tasks)} running tasks\n")
+    for task in tasks:
+        out.write(f"--- {task!r}\n")
+        task.print_stack(file=out)
+    return out.getvalue()
+
+
+class ProfilingMode:
+    """Wires slow-callback detection, lag sampling and signal handlers into the running loop."""
+
+    def __init__(self, slow_callback: float = 0.1, lag_interval: float = 0.5,
+                 profiler: str = 'sampling', output: str = 'profile', asyncio_debug: bool = False):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profiler}")
+        self.slow_callback = slow_callback
+        self.profiler = profiler
+        self.output = output
+        self.asyncio_debug = asyncio_debug
+        self.slow_monitor = SlowCallbackMonitor(slow_callback)
+        self.lag_monitor = LoopLagMonitor(lag_interval, slow_callback)
+        self._active = None
+        self._runs = 0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional['ProfilingMode']:
+        if not args.profile:
+            return None
+        return cls(args.profile_slow_callback, args.profile_lag_interval, args.profiler, args.profile_output,
+                   getattr(args, 'profile_asyncio_debug', False))
+
+    def install(self):
+        """Enable profiling on the running event loop."""
+        loop = asyncio.get_event_loop()
+        if self.asyncio_debug:
+            loop.set_debug(True)
+            # Slow callbacks are reported by slow_monitor, not twice by asyncio
+            loop.slow_callback_duration = float('inf')
+        self.slow_monitor.start()
+        self.lag_monitor.start()
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, self.dump_tasks)
+            loop.add_signal_handler(signal.SIGUSR2, self.toggle_profiler)
+        logger.info(f"Profiling enabled (pid {os.getpid()}): SIGUSR1 dumps tasks, SIGUSR2 toggles {self.profiler} profiler")
+
+    def uninstall(self):
+        """Stop sampling and flush a running profiler."""
+        self.lag_monitor.stop()
+        self.slow_monitor.stop()
+        if self.asyncio_debug:
+            asyncio.get_event_loop().set_debug(False)
+        if hasattr(signal, 'SIGUSR1'):
+            loop = asyncio.get_event_loop()
+            loop.remove_signal_handler(signal.SIGUSR1)
+            loop.remove_signal_handler(signal.SIGUSR2)
+        if self._active is not None:
+            self.toggle_profiler()
+
+    def dump_tasks(self):
+        logger.info(f"Event loop lag: last {self.lag_monitor.last_lag * 1000:.1f} ms, "
+                    f"mean {self.lag_monitor.mean_lag * 1000:.1f} ms, max {self.lag_monitor.max_lag * 1000:.1f} ms")
+        logger.info(format_tasks())
+
+    def toggle_profiler(self) -> Optional[str]:
+        """Start the profiler, or stop it and return the path of the written file."""
+        if self._active is None:
+            if self.profiler == 'cprofile':
+                import cProfile
+                self._active = cProfile.Profile()
+                self._active.enable()
+            else:
+                self._active = StackSampler(threading.get_ident())
+                self._active.start()
+            logger.info(f"Started {self.profiler} profiler")
+            return None
+
+        self._runs += 1
+        if self.profiler == 'cprofile':
+            self._active.disable()
+            path = f"{self.output}-{os.getpid()}-{self._runs}.pstats"
+            self._active.dump_stats(path)
+        else:
+            self._active.stop()
+            path = f"{self.output}-{os.getpid()}-{self._runs}.collapsed"
+            self._active.write_collapsed(path)
+        self._active = None
+        logger.info(f"Stopped {self.profiler} profiler, wrote {path}")
+        return path
@@ -0,0 +1,166 @@
+"""
+This module contains the message serialization layer used by the server.
+
+Messages are encoded to newline-terminated JSON frames once and then shared:
+frames for repeated or immutable messages are kept in a byte-bounded LRU
+cache, fan-out sends one frame to many peers, and large messages are encoded
+off the event loop. The json C encoder holds the GIL for a whole call, so a
+large list or dict is encoded in slices on a worker thread; the GIL is released
+between slices and the loop keeps running. The output is byte-identical to
+json.dumps(message).
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+OFFLOAD_ITEMS = 5000
+CHUNK_ITEMS = 5000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def encode_frame(message: dict) -> bytes:
+    """Encode a message as a newline-terminated JSON frame."""
+    return json.dumps(message).encode() + b'\n'
+
+
+def _encode_value(value, chunk_items: int) -> bytes:
+    if isinstance(value, list) and len(value) > chunk_items:
+        slices = [json.dumps(value[i:i + chunk_items])[1:-1].encode()
+                  for i in range(0, len(value), chunk_items)]
+        return b'[' + b', '.join(slices) + b']'
+    if isinstance(value, dict) and len(value) > chunk_items:
+        items = list(value.items())
+        slices = [json.dumps(dict(items[i:i + chunk_items]))[1:-1].encode()
+                  for i in range(0, len(items), chunk_items)]
+        return b'{' + b', '.join(slices) + b'}'
+    return json.dumps(value).encode()
+
+
+def encode_frame_chunked(message: dict, chunk_items: int = CHUNK_ITEMS) -> bytes:
+    """Same output as encode_frame, but large top-level lists and dicts are encoded in slices."""
+    items = [json.dumps(key).encode() + b': ' + _encode_value(value, chunk_items)
+             for key, value in message.items()]
+    return b'{' + b', '.join(items) + b'}\n'
+
+
+def is_large(message: dict, offload_items: int = OFFLOAD_ITEMS) -> bool:
+    """Cheap top-level check for messages worth encoding off the event loop."""
+    return any(isinstance(value, (list, dict)) and len(value) > offload_items
+               for value in message.values())
+
+
+class FrameCache:
+    """LRU cache of encoded frames bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames: "OrderedDict[Hashable, bytes]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key: Hashable, frame: bytes):
+        if len(frame) > self.max_bytes:
+            return
+        old = self._frames.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._frames[key] = frame
+        self.size += len(frame)
+        while self.size > self.max_bytes:
+            _, evicted = self._frames.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, key: Hashable):
+        frame = self._frames.pop(key, None)
+        if frame is not None:
+            self.size -= len(frame)
+
+
+class Serializer:
+    """Encodes, caches and fans out message frames for a server."""
+
+    def __init__(self, executor: Optional[Executor] = None, offload_items: int = OFFLOAD_ITEMS,
+                 chunk_items: int = CHUNK_ITEMS, cache_max_bytes: int = CACHE_MAX_BYTES):
+        self.executor = executor
+        self.offload_items = offload_items
+        self.chunk_items = chunk_items
+        self.cache = FrameCache(cache_max_bytes)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def _get_executor(self) -> Executor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='serializer')
+        return self.executor
+
+    def cached(self, key: Hashable, message: dict) -> bytes:
+        """Return the frame for an immutable message, encoding it on first use."""
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = encode_frame(message)
+            self.cache.put(key, frame)
+        return frame
+
+    async def encode(self, message: dict) -> bytes:
+        """Encode a message, moving large ones to a worker thread."""
+        if not is_large(message, self.offload_items):
+            return encode_frame(message)
+        return await asyncio.get_event_loop().run_in_executor(
+            self._get_executor(), encode_frame_chunked, message, self.chunk_items)
+
+    async def cached_async(self, key: Hashable, build: Callable[[], dict]) -> bytes:
+        """
+        Return the cached frame for key, or encode build() once and cache it.
+        Concurrent callers for the same key share a single encoding.
+        """
+        frame = self.cache.get(key)
+        if frame is not None:
+            return frame
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.ensure_future(self.encode(build()))
+        self._inflight[key] = fut
+        try:
+            frame = await asyncio.shield(fut)
+        finally:
+            current = self._inflight.get(key) is fut
+            if current:
+                del self._inflight[key]
+        if current:
+            # Not cached if the key was discarded while encoding
+            self.cache.put(key, frame)
+        return frame
+
+    def discard(self, key: Hashable):
+        """Drop the cached frame for key, including one still being encoded."""
+        self.cache.discard(key)
+        self._inflight.pop(key, None)
+
+    async def fan_out(self, peers: Iterable, message: dict) -> int:
+        """Encode message once and send the same frame to every peer. Returns the number of failed sends."""
+        frame = await self.encode(message)
+        results = await asyncio.gather(*(peer.send_frame(frame) for peer in peers), return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        for error in failed:
+            logger.error(f"Fan-out send failed: {error}")
+        return len(failed)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
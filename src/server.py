@@ -3,6 +3,8 @@ import logging
 import json
 from typing import Dict, Set
 from .peer import Peer
+from .peer_index import TagIndex, validate_tags
+from .serialization import Serializer
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +14,10 @@ class Server:
         self.port = port
         self.peers: Dict[str, Peer] = {}
         self.pending_connections: Set[str] = set()
+        self.tag_index = TagIndex()
+        self.serializer = Serializer()
+        # Bumped whenever the peer list changes; keys the cached peer_list frame
+        self.membership_version = 0
 
     async def start(self):
         """Start the server and listen for incoming connections."""
@@ -31,9 +37,10 @@ class Server:
         logger.info(f'New connection from {peer_addr}')
 
         peer = Peer(reader, writer)
-        peer_id = f"{peer_addr[0]}:{peer_addr[1]}"
+        peer_id = self.make_peer_id(peer_addr)
         peer.public_addr = peer_addr  # Store public address on the peer object
         self.peers[peer_id] = peer
+        self._membership_changed()
 
         try:
             while True:
@@ -68,13 +75,21 @@ class Server:
             await self.handle_punch_request(peer_id, message)
         elif msg_type == 'list_peers':
             await self.handle_list_peers(peer_id)
+        elif msg_type == 'query_peers':
+            await self.handle_query_peers(peer_id, message)
 
     async def handle_register(self, peer_id: str, message: dict):
         """Handle peer registration."""
+        peer = self.peers[peer_id]
+        try:
+            tags = validate_tags(message.get('tags'))
+        except ValueError as e:
+            await peer.send({'type': 'error', 'message': f'Invalid tags: {e}'})
+            return
         logger.info(f"Registered peer {peer_id}")
         # Store public address for this peer
-        peer = self.peers[peer_id]
         peer.public_addr = peer.writer.get_extra_info('peername')
+        self.tag_index.add(peer_id, tags)
         response = {
             'type': 'register_ack',
             'peer_id': peer_id,
@@ -85,29 +100,43 @@ class Server:
     async def handle_connect_request(self, peer_id: str, message: dict):
         """Handle connection requests between peers."""
         target_id = message.get('target_id')
-        if not target_id or target_id not in self.peers:
-            await self.peers[peer_id].send({
+        request_id = message.get('request_id')
+        if not target_id or not self.has_peer(target_id):
+            error = {
                 'type': 'error',
                 'message': 'Target peer not found'
-            })
+            }
+            if request_id is not None:
+                error['request_id'] = request_id
+                await self.peers[peer_id].send(error)
+            else:
+                await self.peers[peer_id].send_frame(self.serializer.cached(('error', 'target_not_found'), error))
             return
 
         # Notify both peers about the connection request, including public IP/port
-        await self.peers[peer_id].send({
+        ready = {
             'type': 'connect_ready',
             'target_id': target_id,
-            'target_addr': self.peers[target_id].public_addr
-        })
-        await self.peers[target_id].send({
+            'target_addr': self.get_peer_addr(target_id)
+        }
+        if request_id is not None:
+            # Lets headless clients match the reply to their pending connect()
+            ready['request_id'] = request_id
+        await self.peers[peer_id].send(ready)
+        notice = {
             'type': 'connect_ready',
             'target_id': peer_id,
             'target_addr': self.peers[peer_id].public_addr
-        })
+        }
+        if request_id is not None:
+            # Echoed back in the target's punch reply
+            notice['request_id'] = request_id
+        await self.send_to_peer(target_id, notice)
 
     async def handle_punch_request(self, peer_id: str, message: dict):
         """Handle NAT punch requests."""
         target_id = message.get('target_id')
-        if not target_id or target_id not in self.peers:
+        if not target_id or not self.has_peer(target_id):
             return
 
         # Forward punch request to target peer, including peer_id and target_addr
@@ -117,16 +146,74 @@ class Server:
             'port': message.get('port', 0),
             'target_addr': self.peers[peer_id].public_addr
         }
-        await self.peers[target_id].send(punch_msg)
+        if message.get('request_id') is not None:
+            punch_msg['request_id'] = message['request_id']
+        await self.send_to_peer(target_id, punch_msg)
+
+    def make_peer_id(self, addr) -> str:
+        """Return the ID assigned to a peer connecting from addr."""
+        return f"{addr[0]}:{addr[1]}"
+
+    def has_peer(self, peer_id: str) -> bool:
+        """Return True if peer_id can be reached through this server."""
+        return peer_id in self.peers
+
+    def get_peer_addr(self, peer_id: str):
+        """Return the public address of a reachable peer."""
+        return self.peers[peer_id].public_addr
+
+    async def send_to_peer(self, peer_id: str, message: dict):
+        """Deliver a message to a reachable peer."""
+        await self.peers[peer_id].send(message)
+
+    async def broadcast(self, message: dict, peer_ids=None):
+        """Send one message to many peers (all by default), encoding it only once."""
+        targets = self.peers if peer_ids is None else peer_ids
+        peers = [self.peers[pid] for pid in targets if pid in self.peers]
+        return await self.serializer.fan_out(peers, message)
+
+    def _membership_changed(self):
+        self.serializer.discard(('peer_list', self.membership_version))
+        self.membership_version += 1
+
+    async def _peer_list_frame(self, list_peers) -> bytes:
+        """Return the encoded peer_list for the current membership, encoding at most once per change."""
+        return await self.serializer.cached_async(
+            ('peer_list', self.membership_version),
+            lambda: {'type': 'peer_list', 'peers': list_peers()})
 
     async def handle_list_peers(self, peer_id: str):
         """Send the list of registered peer IDs to the requesting client."""
-        peer_list = list(self.peers.keys())
-        await self.peers[peer_id].send({'type': 'peer_list', 'peers': peer_list})
+        frame = await self._peer_list_frame(lambda: list(self.peers.keys()))
+        await self.peers[peer_id].send_frame(frame)
+
+    async def handle_query_peers(self, peer_id: str, message: dict):
+        """Send one page of registered peers whose tags match the query filters."""
+        request_id = message.get('request_id')
+        try:
+            filters = validate_tags(message.get('tags'))
+            limit = int(message.get('limit', 100))
+            cursor = message.get('cursor')
+            if cursor is not None and not isinstance(cursor, str):
+                raise ValueError("cursor must be a string")
+        except (TypeError, ValueError) as e:
+            response = {'type': 'error', 'message': f'Invalid query: {e}'}
+        else:
+            page, next_cursor = self.tag_index.query(filters, limit, cursor)
+            response = {
+                'type': 'query_result',
+                'peers': [{'peer_id': pid, 'tags': tags} for pid, tags in page],
+                'next_cursor': next_cursor
+            }
+        if request_id is not None:
+            response['request_id'] = request_id
+        await self.peers[peer_id].send(response)
 
     async def remove_peer(self, peer_id: str):
         """Remove a peer from the server."""
+        self.tag_index.remove(peer_id)
         if peer_id in self.peers:
             await self.peers[peer_id].close()
             del self.peers[peer_id]
+            self._membership_changed()
             logger.info(f"Peer {peer_id} disconnected")
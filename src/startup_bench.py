@@ -0,0 +1,91 @@
+"""
+Startup-time benchmark for each run mode.
+
+For every mode it reports, as the median over several fresh interpreters:
+  * import  - time to import the modules that mode needs
+  * ready   - time from process spawn until the server is serving or the
+              client has registered with a rendezvous server
+
+Usage: python -m src.startup_bench [--runs 5] [--loop asyncio|uvloop|auto]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from .loop import LOOP_CHOICES, install_event_loop
+
+MODES = {
+    'server': {'modules': ['src.main', 'src.server'], 'marker': b'Serving on'},
+    'client': {'modules': ['src.main', 'src.client'], 'marker': b'Registered with server'},
+    'client-app': {'modules': ['src.main', 'src.client', 'src.tcp_relay'], 'marker': b'Registered with server'},
+}
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(modules, runs: int) -> float:
+    """Median seconds to import modules in a fresh interpreter."""
+    code = ("import time; t = time.perf_counter(); "
+            + "; ".join(f"import {m}" for m in modules)
+            + "; print(time.perf_counter() - t)")
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], cwd=_ROOT, check=True,
+                             capture_output=True, text=True).stdout
+        samples.append(float(out.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+async def measure_ready(args, marker: bytes, timeout: float = 10.0) -> float:
+    """Seconds from spawning src.main with args until marker is logged."""
+    start = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'src.main', *args, cwd=_ROOT,
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while True:
+            line = await asyncio.wait_for(proc.stderr.readline(), timeout)
+            if not line:
+                raise RuntimeError(f"src.main {' '.join(args)} exited before becoming ready")
+            if marker in line:
+                return time.perf_counter() - start
+    finally:
+        proc.kill()
+        await proc.wait()
+
+
+async def run(runs: int, loop_name: str):
+    from .server import Server
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = Server('127.0.0.1', port)
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.1)
+
+    print(f"{'mode':<12}{'import (ms)':>14}{'ready (ms)':>14}")
+    try:
+        for mode, spec in MODES.items():
+            import_time = measure_import(spec['modules'], runs)
+            if mode == 'server':
+                argv = ['--mode', 'server', '--host', '127.0.0.1', '--port', '0']
+            else:
+                argv = ['--mode', mode, '--server-host', '127.0.0.1', '--server-port', str(port)]
+            argv += ['--loop', loop_name]
+            ready = statistics.median([await measure_ready(argv, spec['marker']) for _ in range(runs)])
+            print(f"{mode:<12}{import_time * 1000:>14.1f}{ready * 1000:>14.1f}")
+    finally:
+        server_task.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import and time-to-registered for each mode")
+    parser.add_argument('--runs', type=int, default=5, help='Runs per measurement (median is reported)')
+    parser.add_argument('--loop', choices=LOOP_CHOICES, default='asyncio', help='Event loop for all processes')
+    args = parser.parse_args()
+    print(f"event loop: {install_event_loop(args.loop)}")
+    asyncio.run(run(args.runs, args.loop))
@@ -1,21 +1,198 @@
 import asyncio
+import json
 import logging
+import secrets
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from .compression import (HANDSHAKE_TIMEOUT, CompressionStats, CompressedReader, CompressedWriter,
+                          negotiate_client, negotiate_server, read_hello)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+COMPRESS_READ_SIZE = 64 * 1024
+
 class TCPRelayServer:
-    def __init__(self, listen_host: str, listen_port: int, target_host: str, target_port: int):
+    def __init__(self, listen_host: str, listen_port: int, target_host: str, target_port: int,
+                 compress_level: Optional[int] = None, compress_side: Optional[str] = None,
+                 migrate: bool = False, rendezvous: Optional[Tuple[str, int]] = None,
+                 migrate_timeout: float = 15.0, handshake_timeout: float = HANDSHAKE_TIMEOUT):
+        """
+        compress_side selects which leg of the relay carries the compressed
+        stream protocol: 'target' for the client-app side (compress towards the
+        remote relay), 'client' for the relay accepting compressed streams.
+        compress_level is the proposed level ('target') or the maximum accepted
+        level ('client').
+
+        With migrate, both relays register as headless peers with the
+        rendezvous server (host, port). The 'client' side offers its peer ID in
+        the handshake and the 'target' side asks the rendezvous server for a
+        connect, so both peers punch from their registered ports at once. On
+        success the stream is handed over to the direct path and the relayed
+        connection, with any relay in between, is released.
+        """
+        if compress_side not in (None, 'target', 'client'):
+            raise ValueError(f"Invalid compress_side: {compress_side}")
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.target_host = target_host
         self.target_port = target_port
+        self.compress_level = 6 if compress_level is None else compress_level
+        self.compress_side = compress_side
+        self.migrate = migrate
+        self.rendezvous = rendezvous
+        self.migrate_timeout = migrate_timeout
+        self.handshake_timeout = handshake_timeout
+        self.stream_stats: Dict[str, CompressionStats] = {}
+        self.migrated_streams: Dict[str, bool] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 'client' side: streams that may be migrated, by token
+        self._migratable: Dict[str, Tuple[str, CompressedReader, CompressedWriter]] = {}
+        # 'target' side: background migration attempts, by stream
+        self._migrations: Dict[str, asyncio.Task] = {}
+        # Headless peer registered with the rendezvous server, used for migration
+        self._peer = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix='relay-zlib')
+        return self._executor
+
+    async def _join_rendezvous(self, attempts: int = 5, delay: float = 0.5):
+        """Register a headless peer with the rendezvous server; migration is off if this fails."""
+        from .client import Client
+        host, port = self.rendezvous
+        for attempt in range(attempts):
+            peer = Client(host, port, interactive=False)
+            try:
+                await peer.open()
+            except Exception as e:
+                logger.debug(f"Rendezvous {host}:{port} not reachable (attempt {attempt+1}): {e}")
+                await asyncio.sleep(delay)
+                continue
+            self._peer = peer
+            logger.info(f"Relay registered with rendezvous server as {peer.peer_id}")
+            if self.compress_side == 'client':
+                asyncio.create_task(self._serve_punched(peer))
+            return
+        logger.warning(f"Could not register with rendezvous server {host}:{port}, streams stay relayed")
+
+    async def _serve_punched(self, peer):
+        """Serve direct connections punched by the other relay like any accepted connection."""
+        while True:
+            conn = await peer.incoming_connections.get()
+            asyncio.create_task(self.handle_client(conn.reader, conn.writer))
+
+    async def _wrap_compressed(self, reader, writer, stream_id: str, hello: Optional[dict] = None):
+        """Negotiate compression on one leg and return (reader, writer) to relay through."""
+        ack = {}
+        token = None
+        if self.compress_side == 'target':
+            ack = await negotiate_client(reader, writer, self.compress_level, self.handshake_timeout)
+            level = ack['level']
+        else:
+            offer = None
+            if self.migrate and self._peer is not None:
+                token = secrets.token_hex(16)
+                offer = {'migrate': {'token': token, 'peer_id': self._peer.peer_id}}
+            level = await negotiate_server(reader, writer, self.compress_level, hello, offer)
+        if level <= 0:
+            logger.info(f"Compression declined for stream {stream_id}")
+            if self.migrate:
+                # Handover frames need the compressed framing
+                logger.warning(f"Stream {stream_id} cannot migrate: the other relay negotiated compression level 0")
+            return reader, writer
+        logger.info(f"Negotiated compression level {level} for stream {stream_id}")
+        stats = CompressionStats()
+        self.stream_stats[stream_id] = stats
+        executor = self._get_executor()
+        creader = CompressedReader(reader, stats, executor)
+        cwriter = CompressedWriter(writer, level, stats, executor)
+        if token:
+            self._migratable[token] = (stream_id, creader, cwriter)
+        elif self._peer is not None and ack.get('migrate'):
+            self._migrations[stream_id] = asyncio.create_task(
+                self._migrate(stream_id, ack['migrate'], creader, cwriter))
+        return creader, cwriter
+
+    async def _migrate(self, stream_id: str, offer: dict, creader: CompressedReader, cwriter: CompressedWriter):
+        """Punch a direct path to the far relay in the background and move the stream onto it."""
+        peer_id = offer['peer_id']
+        try:
+            conn = await self._peer.connect(peer_id, timeout=self.migrate_timeout)
+        except Exception as e:
+            logger.info(f"No direct path to relay {peer_id}, stream {stream_id} stays relayed: {e}")
+            return
+        new_reader, new_writer = conn.reader, conn.writer
+        try:
+            new_writer.write(json.dumps({'type': 'migrate', 'token': offer['token']}).encode() + b'\n')
+            await new_writer.drain()
+            data = await new_reader.readline()
+            reply = json.loads(data.decode()) if data else {}
+            if reply.get('type') != 'migrate_ack':
+                raise ConnectionError(f"Migration refused: {reply}")
+        except Exception as e:
+            logger.info(f"Migration of stream {stream_id} failed: {e}")
+            new_writer.close()
+            return
+        await self._hand_over(stream_id, creader, cwriter, new_reader, new_writer)
+
+    async def _accept_migration(self, hello: dict, reader, writer):
+        """Answer a migrate request arriving on the direct path."""
+        entry = self._migratable.pop(hello.get('token'), None)
+        if entry is None:
+            writer.write(json.dumps({'type': 'error', 'message': 'Unknown stream'}).encode() + b'\n')
+            await writer.drain()
+            writer.close()
+            return
+        stream_id, creader, cwriter = entry
+        writer.write(json.dumps({'type': 'migrate_ack'}).encode() + b'\n')
+        await writer.drain()
+        await self._hand_over(stream_id, creader, cwriter, reader, writer)
+
+    async def _hand_over(self, stream_id: str, creader: CompressedReader, cwriter: CompressedWriter,
+                         new_reader, new_writer):
+        """Switch both directions of a stream to the new path, then release the old one."""
+        creader.attach(new_reader)
+        old_writer = await cwriter.switch(new_writer)
+        try:
+            await asyncio.wait_for(creader.switched.wait(), self.migrate_timeout)
+        except asyncio.TimeoutError:
+            # Our frames already go out on the new path and cannot be replayed on the
+            # old one, so the stream cannot continue; closing both paths ends it
+            logger.warning(f"Peer did not hand over stream {stream_id}, closing the stream")
+            new_writer.close()
+            old_writer.close()
+            return
+        old_writer.close()
+        self.migrated_streams[stream_id] = True
+        logger.info(f"Stream {stream_id} migrated to direct path, relay released")
 
     async def handle_client(self, client_reader, client_writer):
         client_addr = client_writer.get_extra_info('peername')
+        stream_id = f"{client_addr[0]}:{client_addr[1]}" if client_addr else str(id(client_writer))
         logger.info(f"Accepted connection from {client_addr}")
+        read_size = COMPRESS_READ_SIZE if self.compress_side else 4096
+        hello = None
+        if self.compress_side == 'client':
+            try:
+                hello = await read_hello(client_reader, self.handshake_timeout)
+            except Exception as e:
+                logger.error(f"Compression negotiation with {client_addr} failed: {e}")
+                client_writer.close()
+                return
+            if hello.get('type') == 'migrate':
+                # The connection now belongs to the migrated stream's relay loop
+                await self._accept_migration(hello, client_reader, client_writer)
+                return
         try:
+            if self.compress_side == 'client':
+                try:
+                    client_reader, client_writer = await self._wrap_compressed(client_reader, client_writer, stream_id, hello)
+                except Exception as e:
+                    logger.error(f"Compression negotiation with {client_addr} failed: {e}")
+                    return
             # Connect to the target server
             try:
                 target_reader, target_writer = await asyncio.open_connection(self.target_host, self.target_port)
@@ -28,11 +205,19 @@ class TCPRelayServer:
                 client_writer.close()
                 await client_writer.wait_closed()
                 return
+            if self.compress_side == 'target':
+                try:
+                    target_reader, target_writer = await self._wrap_compressed(target_reader, target_writer, stream_id)
+                except Exception as e:
+                    # Close both legs; the client's connection is closed on the way out
+                    logger.error(f"Compression negotiation with {self.target_host}:{self.target_port} failed: {e}")
+                    target_writer.close()
+                    return
 
             async def relay(reader, writer, direction):
                 try:
                     while True:
-                        data = await reader.read(4096)
+                        data = await reader.read(read_size)
                         if not data:
                             break
                         writer.write(data)
@@ -60,10 +245,22 @@ class TCPRelayServer:
                 await client_writer.wait_closed()
             except Exception as e:
                 logger.info(f"Error closing client_writer: {e}")
+            migration = self._migrations.pop(stream_id, None)
+            if migration:
+                migration.cancel()
+            for token, entry in list(self._migratable.items()):
+                if entry[0] == stream_id:
+                    del self._migratable[token]
+            self.migrated_streams.pop(stream_id, None)
+            stats = self.stream_stats.pop(stream_id, None)
+            if stats:
+                logger.info(f"Compression stats for {stream_id}: {stats.as_dict()}")
             logger.info(f"Closed client connection from {client_addr}")
 
     async def start(self):
         try:
+            if self.migrate and self.rendezvous:
+                await self._join_rendezvous()
             server = await asyncio.start_server(self.handle_client, self.listen_host, self.listen_port)
             logger.info(f"TCP relay listening on {self.listen_host}:{self.listen_port}, forwarding to {self.target_host}:{self.target_port}")
             async with server:
@@ -71,15 +268,48 @@ class TCPRelayServer:
         except Exception as e:
             logger.error(f"Relay server failed to start: {e}")
             logger.error(traceback.format_exc())
+        finally:
+            if self._peer is not None:
+                await self._peer.close()
+                self._peer = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+async def _run_with_profiling(relay: TCPRelayServer, profiling):
+    if profiling:
+        profiling.install()
+    try:
+        await relay.start()
+    finally:
+        if profiling:
+            profiling.uninstall()
 
 if __name__ == "__main__":
     import argparse
+    from .loop import add_loop_argument, install_event_loop
+    from .profiling import ProfilingMode, add_profile_arguments
     parser = argparse.ArgumentParser(description="Simple TCP Relay Server")
     parser.add_argument('--listen-host', default='0.0.0.0', help='Relay listen host (default: 0.0.0.0)')
     parser.add_argument('--listen-port', type=int, required=True, help='Relay listen port')
     parser.add_argument('--target-host', required=True, help='Target host to forward to')
     parser.add_argument('--target-port', type=int, required=True, help='Target port to forward to')
+    parser.add_argument('--compress-side', choices=['target', 'client'], default=None,
+                        help='Leg that carries the compressed stream protocol (default: none)')
+    parser.add_argument('--compress-level', type=int, default=None, choices=range(10),
+                        help='zlib level to propose (target) or maximum to accept (client)')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Move compressed streams onto a direct punched path when possible (needs --rendezvous)')
+    parser.add_argument('--rendezvous', default=None, metavar='HOST:PORT',
+                        help='Rendezvous server that coordinates the punch for --migrate')
+    add_profile_arguments(parser)
+    add_loop_argument(parser)
     args = parser.parse_args()
+    install_event_loop(args.loop)
 
-    relay = TCPRelayServer(args.listen_host, args.listen_port, args.target_host, args.target_port)
-    asyncio.run(relay.start())
+    relay = TCPRelayServer(args.listen_host, args.listen_port, args.target_host, args.target_port,
+                           compress_level=args.compress_level, compress_side=args.compress_side,
+                           migrate=args.migrate,
+                           rendezvous=(args.rendezvous.rsplit(':', 1)[0], int(args.rendezvous.rsplit(':', 1)[1]))
+                           if args.rendezvous else None)
+    asyncio.run(_run_with_profiling(relay, ProfilingMode.from_args(args)))
@@ -1,7 +1,11 @@
 import pytest
+import pytest_asyncio
 import asyncio
 import json
+import socket
 from src.client import Client
+from src.connection import PeerConnectionPool
+from src.server import Server
 
 @pytest.fixture
 async def mock_server():
@@ -57,3 +61,134 @@ async def test_client_registration(mock_server):
         await client_task
     except asyncio.CancelledError:
         pass
+
+@pytest_asyncio.fixture
+async def rendezvous_server():
+    # Mock rendezvous server that answers connect requests for known targets
+    targets = {}
+    listeners = []
+    for i in range(5):
+        listener = await asyncio.start_server(lambda r, w: None, '127.0.0.1', 0)
+        listeners.append(listener)
+        targets[f'peer{i}'] = list(listener.sockets[0].getsockname())
+    # A target that never answers the punch: its port refuses connections
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        targets['dead'] = list(s.getsockname())
+
+    async def handle(reader, writer):
+        peername = writer.get_extra_info('peername')
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            message = json.loads(data.decode())
+            if message.get('type') == 'register':
+                response = {'type': 'register_ack', 'peer_id': f"{peername[0]}:{peername[1]}"}
+            elif message.get('type') == 'connect':
+                target_id = message.get('target_id')
+                if target_id in targets:
+                    response = {'type': 'connect_ready', 'target_id': target_id,
+                                'target_addr': targets[target_id], 'request_id': message.get('request_id')}
+                else:
+                    response = {'type': 'error', 'message': 'Target peer not found',
+                                'request_id': message.get('request_id')}
+            else:
+                continue
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+
+    yield server.sockets[0].getsockname()
+
+    server.close()
+    await server.wait_closed()
+    for listener in listeners:
+        listener.close()
+
+@pytest.mark.asyncio
+async def test_headless_concurrent_connect(rendezvous_server):
+    host, port = rendezvous_server
+    client = Client(host, port, interactive=False, max_concurrent_connects=3)
+    await client.open()
+
+    conns = await asyncio.gather(*(client.connect(f'peer{i}', timeout=5) for i in range(5)))
+    assert [conn.peer_id for conn in conns] == [f'peer{i}' for i in range(5)]
+    assert all(conn.is_alive() for conn in conns)
+
+    with pytest.raises(ConnectionError):
+        await client.connect('missing', timeout=5)
+
+    await client.close()
+
+@pytest.mark.asyncio
+async def test_connection_pool_reuses_live_links(rendezvous_server):
+    host, port = rendezvous_server
+    client = Client(host, port, interactive=False)
+    await client.open()
+    pool = PeerConnectionPool(client)
+
+    first, second = await asyncio.gather(pool.get('peer0'), pool.get('peer0'))
+    assert first is second
+    assert await pool.get('peer0') is first
+
+    pool.discard('peer0')
+    assert not first.is_alive()
+    assert await pool.get('peer0') is not first
+
+    pool.close_all()
+    await client.close()
+
+@pytest.mark.asyncio
+async def test_connect_timeout_covers_hole_punch(rendezvous_server):
+    host, port = rendezvous_server
+    client = Client(host, port, interactive=False)
+    await client.open()
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    with pytest.raises(asyncio.TimeoutError):
+        await client.connect('dead', timeout=1)
+    assert loop.time() - started < 3
+
+    await client.close()
+
+@pytest.mark.asyncio
+async def test_headless_connect_through_real_server():
+    server = Server('127.0.0.1', 0)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        server.port = s.getsockname()[1]
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.1)
+
+    a = Client('127.0.0.1', server.port, interactive=False)
+    b = Client('127.0.0.1', server.port, interactive=False)
+    await a.open()
+    await b.open()
+
+    for _ in range(3):
+        conn = await a.connect(b.peer_id, timeout=10)
+        incoming = await asyncio.wait_for(b.incoming_connections.get(), timeout=10)
+        assert incoming.peer_id == a.peer_id
+
+        await conn.send(b'ping')
+        assert await asyncio.wait_for(incoming.reader.readexactly(4), timeout=5) == b'ping'
+        await incoming.send(b'pong')
+        assert await asyncio.wait_for(conn.reader.readexactly(4), timeout=5) == b'pong'
+
+        await conn.wait_closed()
+        await incoming.wait_closed()
+
+    # The target's punch replies were matched to connect(), not punched again
+    assert a.incoming_connections.empty()
+
+    await a.close()
+    await b.close()
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,156 @@
+import pytest
+import pytest_asyncio
+import asyncio
+import json
+from src.cluster import ClusterServer, _auth
+
+SECRET = 'test-secret'
+
+async def wait_for(predicate, timeout=5.0):
+    end = asyncio.get_event_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_event_loop().time() < end, "condition not met in time"
+        await asyncio.sleep(0.02)
+
+async def register(port, tags=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(json.dumps({'type': 'register', 'tags': tags}).encode() + b'\n')
+    await writer.drain()
+    ack = json.loads(await reader.readline())
+    return reader, writer, ack['peer_id']
+
+async def request(reader, writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+    return json.loads(await asyncio.wait_for(reader.readline(), timeout=5))
+
+@pytest_asyncio.fixture
+async def cluster():
+    first = ClusterServer('127.0.0.1', 0, node_id='a', secret=SECRET)
+    tasks = [asyncio.create_task(first.start())]
+    await wait_for(lambda: first.port != 0)
+    # Each node only knows the previous one; the mesh is completed by gossip
+    nodes = [first]
+    for node_id in ('b', 'c'):
+        node = ClusterServer('127.0.0.1', 0, node_id=node_id, secret=SECRET,
+                             seeds=[('127.0.0.1', nodes[-1].cluster_port)])
+        tasks.append(asyncio.create_task(node.start()))
+        await wait_for(lambda: node.port != 0)
+        nodes.append(node)
+    await wait_for(lambda: all(len(node.nodes) == 2 for node in nodes))
+
+    yield nodes
+
+    for task in tasks:
+        task.cancel()
+
+@pytest.mark.asyncio
+async def test_directory_replicated_across_nodes(cluster):
+    a, b, c = cluster
+    reader, writer, peer_id = await register(a.port, {'role': 'relay'})
+    await wait_for(lambda: all(peer_id in node.directory for node in cluster))
+    assert peer_id.startswith('a/')
+    assert c.directory[peer_id][0] == 'a'
+    assert c.tag_index.query({'role': 'relay'})[0] == [(peer_id, {'role': 'relay'})]
+
+    writer.close()
+    await wait_for(lambda: all(peer_id not in node.directory for node in cluster))
+    assert c.tag_index.query({'role': 'relay'})[0] == []
+
+@pytest.mark.asyncio
+async def test_connect_and_punch_forwarded_between_nodes(cluster):
+    a, b, c = cluster
+    reader1, writer1, peer1 = await register(a.port)
+    reader2, writer2, peer2 = await register(c.port)
+    await wait_for(lambda: peer1 in c.directory and peer2 in a.directory)
+
+    peers = await request(reader2, writer2, {'type': 'list_peers'})
+    assert set(peers['peers']) == {peer1, peer2}
+
+    ready = await request(reader1, writer1, {'type': 'connect', 'target_id': peer2, 'request_id': '1'})
+    assert ready['type'] == 'connect_ready'
+    assert ready['target_id'] == peer2
+    assert ready['request_id'] == '1'
+    forwarded = json.loads(await asyncio.wait_for(reader2.readline(), timeout=5))
+    assert forwarded == {'type': 'connect_ready', 'target_id': peer1, 'target_addr': list(a.directory[peer1][1]),
+                         'request_id': '1'}
+
+    writer1.write(json.dumps({'type': 'punch', 'target_id': peer2, 'port': 1234}).encode() + b'\n')
+    await writer1.drain()
+    punch = json.loads(await asyncio.wait_for(reader2.readline(), timeout=5))
+    assert punch['type'] == 'punch'
+    assert punch['peer_id'] == peer1
+
+    writer1.close()
+    writer2.close()
+
+@pytest.mark.asyncio
+async def test_client_port_does_not_accept_node_messages(cluster):
+    a, b, c = cluster
+    _, _, victim = await register(b.port)
+    await wait_for(lambda: victim in a.directory)
+    reader, writer, attacker = await register(a.port)
+
+    for message in ({'type': 'node_hello', 'node_id': 'evil', 'addr': ['6.6.6.6', 666]},
+                    {'type': 'dir_update', 'op': 'add', 'peer_id': victim, 'node_id': 'a', 'addr': ['6.6.6.6', 666]}):
+        writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+    await asyncio.sleep(0.1)
+
+    assert 'evil' not in a.nodes
+    assert a.directory[victim] == b.directory[victim]
+    assert list(a.directory[victim][1]) != ['6.6.6.6', 666]
+
+@pytest.mark.asyncio
+async def test_node_link_requires_secret(cluster):
+    a, b, c = cluster
+    reader, writer = await asyncio.open_connection('127.0.0.1', a.cluster_port)
+    challenge = json.loads(await reader.readline())
+    assert challenge['type'] == 'node_challenge'
+    hello = {'type': 'node_hello', 'node_id': 'evil', 'addr': ['6.6.6.6', 666], 'nonce': 'n',
+             'auth': _auth(b'wrong-secret', challenge['nonce'], 'evil'),
+             'directory': [['evil/1.2.3.4:5', 'evil', ['6.6.6.6', 666], {}]]}
+    writer.write(json.dumps(hello).encode() + b'\n')
+    await writer.drain()
+
+    assert await asyncio.wait_for(reader.readline(), timeout=5) == b''
+    assert 'evil' not in a.nodes
+    assert 'evil/1.2.3.4:5' not in a.directory
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_node_cannot_publish_other_nodes_peers(cluster):
+    a, b, c = cluster
+    _, _, victim = await register(b.port)
+    await wait_for(lambda: victim in a.directory)
+    original = a.directory[victim]
+
+    # A linked node claiming another node's entry, or an ID outside its namespace
+    await a.handle_node_message('c', {'type': 'dir_update', 'op': 'add', 'peer_id': victim,
+                                      'node_id': 'b', 'addr': ['6.6.6.6', 666]})
+    await a.handle_node_message('c', {'type': 'dir_update', 'op': 'add', 'peer_id': victim,
+                                      'node_id': 'c', 'addr': ['6.6.6.6', 666]})
+    await a.handle_node_message('c', {'type': 'dir_update', 'op': 'remove', 'peer_id': victim, 'node_id': 'b'})
+    assert a.directory[victim] == original
+
+@pytest.mark.asyncio
+async def test_dropped_node_link_is_redialled(cluster):
+    a, b, c = cluster
+    reader, writer, peer_id = await register(b.port)
+    await wait_for(lambda: peer_id in a.directory)
+
+    await a.nodes['b'].close()
+    await wait_for(lambda: 'b' in a.nodes and 'a' in b.nodes)
+    # b's peers are announced again with the new link
+    await wait_for(lambda: peer_id in a.directory)
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_wildcard_cluster_host_advertises_link_address(cluster):
+    a = cluster[0]
+    node = ClusterServer('127.0.0.1', 0, node_id='d', secret=SECRET, cluster_host='0.0.0.0',
+                         seeds=[('127.0.0.1', a.cluster_port)])
+    task = asyncio.create_task(node.start())
+    await wait_for(lambda: 'd' in a.nodes)
+    assert a.node_addrs['d'] == ['127.0.0.1', node.cluster_port]
+    task.cancel()
@@ -0,0 +1,260 @@
+import pytest
+import pytest_asyncio
+import asyncio
+import os
+import socket
+from src.compression import CompressionStats, CompressedReader, CompressedWriter, negotiate_server
+from src.server import Server
+from src.tcp_relay import TCPRelayServer
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def handle_echo(reader, writer):
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+@pytest_asyncio.fixture
+async def stream_pair():
+    accepted = asyncio.get_event_loop().create_future()
+    server = await asyncio.start_server(
+        lambda r, w: accepted.set_result((r, w)),
+        '127.0.0.1',
+        0
+    )
+    addr = server.sockets[0].getsockname()
+    reader, writer = await asyncio.open_connection(*addr)
+    remote_reader, remote_writer = await accepted
+
+    yield writer, remote_reader
+
+    writer.close()
+    remote_writer.close()
+    server.close()
+    await server.wait_closed()
+
+@pytest.mark.asyncio
+async def test_compressed_round_trip(stream_pair):
+    writer, reader = stream_pair
+    stats = CompressionStats()
+    compressed_writer = CompressedWriter(writer, 6, stats, offload_threshold=1024)
+    compressed_reader = CompressedReader(reader, stats, offload_threshold=1024)
+
+    payload = b'hello relay ' * 1000
+    compressed_writer.write(payload)
+    await compressed_writer.drain()
+
+    assert await compressed_reader.read() == payload
+    assert stats.frames_compressed == 1
+    assert stats.ratio < 0.1
+    assert stats.compress_cpu >= 0
+
+@pytest.mark.asyncio
+async def test_negotiated_level_is_clamped_to_zlib_range():
+    sent = []
+
+    class FakeWriter:
+        def write(self, data):
+            sent.append(data)
+        async def drain(self):
+            pass
+
+    level = await negotiate_server(None, FakeWriter(), 12, hello={'type': 'compress_hello', 'level': 12})
+    assert level == 9
+    assert b'"level": 9' in sent[0]
+
+@pytest.mark.asyncio
+async def test_handshake_timeout_closes_both_legs():
+    endpoint_closed = asyncio.Event()
+
+    async def silent(reader, writer):
+        await reader.read()
+        endpoint_closed.set()
+        writer.close()
+
+    endpoint = await asyncio.start_server(silent, '127.0.0.1', 0)
+    endpoint_port = endpoint.sockets[0].getsockname()[1]
+    target_port, client_port = free_port(), free_port()
+    # Compressing towards an endpoint that never answers the handshake
+    towards = TCPRelayServer('127.0.0.1', target_port, '127.0.0.1', endpoint_port,
+                             compress_side='target', handshake_timeout=0.2)
+    # Accepting compressed streams from a client that never sends a handshake line
+    accepting = TCPRelayServer('127.0.0.1', client_port, '127.0.0.1', endpoint_port,
+                               compress_side='client', handshake_timeout=0.2)
+    tasks = [asyncio.create_task(towards.start()), asyncio.create_task(accepting.start())]
+    await asyncio.sleep(0.1)
+
+    for port in (target_port, client_port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'\x00binary without newline')
+        await writer.drain()
+        assert await asyncio.wait_for(reader.read(), timeout=5) == b''
+        writer.close()
+    # The relay also closed its leg to the endpoint
+    await asyncio.wait_for(endpoint_closed.wait(), timeout=5)
+
+    for task in tasks:
+        task.cancel()
+    endpoint.close()
+    await endpoint.wait_closed()
+
+@pytest.mark.asyncio
+async def test_incompressible_payload_disables_compression(stream_pair):
+    writer, reader = stream_pair
+    stats = CompressionStats()
+    compressed_writer = CompressedWriter(writer, 6, stats, sample_bytes=4096, probe_interval=4)
+    compressed_reader = CompressedReader(reader, stats)
+
+    chunks = [os.urandom(4096) for _ in range(3)]
+    for chunk in chunks:
+        compressed_writer.write(chunk)
+        await compressed_writer.drain()
+        assert await compressed_reader.read() == chunk
+
+    assert not compressed_writer.enabled
+    assert stats.disabled_count == 1
+    assert stats.frames_compressed == 0
+
+@pytest.mark.asyncio
+async def test_relay_chain_with_compression():
+    echo = await asyncio.start_server(handle_echo, '127.0.0.1', 0)
+    echo_port = echo.sockets[0].getsockname()[1]
+    remote_port, local_port = free_port(), free_port()
+
+    remote = TCPRelayServer('127.0.0.1', remote_port, '127.0.0.1', echo_port,
+                            compress_level=9, compress_side='client')
+    local = TCPRelayServer('127.0.0.1', local_port, '127.0.0.1', remote_port,
+                           compress_level=6, compress_side='target')
+    tasks = [asyncio.create_task(remote.start()), asyncio.create_task(local.start())]
+    await asyncio.sleep(0.1)
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', local_port)
+    payload = b'{"type": "text", "data": "compressible"}\n' * 500
+    writer.write(payload)
+    await writer.drain()
+    received = await asyncio.wait_for(reader.readexactly(len(payload)), timeout=5)
+    assert received == payload
+
+    stats = next(iter(local.stream_stats.values()))
+    assert stats.ratio < 0.5
+
+    writer.close()
+    for task in tasks:
+        task.cancel()
+    echo.close()
+    await echo.wait_closed()
+
+@pytest.mark.asyncio
+async def test_handover_switches_path_without_loss(stream_pair):
+    writer, reader = stream_pair
+    stats = CompressionStats()
+    compressed_writer = CompressedWriter(writer, 6, stats)
+    compressed_reader = CompressedReader(reader, stats)
+
+    new_reader = asyncio.StreamReader()
+    new_transport_data = []
+
+    class FakeWriter:
+        def write(self, data):
+            new_transport_data.append(data)
+        async def drain(self):
+            pass
+
+    compressed_writer.write(b'before')
+    await compressed_writer.drain()
+    await compressed_writer.switch(FakeWriter())
+    compressed_writer.write(b'after')
+    await compressed_writer.drain()
+
+    new_reader.feed_data(b''.join(new_transport_data))
+    compressed_reader.attach(new_reader)
+    assert await compressed_reader.read() == b'before'
+    assert await compressed_reader.read() == b'after'
+    assert compressed_reader.switched.is_set()
+    assert compressed_reader.seq_in == compressed_writer.seq_out == 11
+
+@pytest.mark.asyncio
+async def test_handover_timeout_closes_both_paths(stream_pair):
+    writer, reader = stream_pair
+    stats = CompressionStats()
+    relay = TCPRelayServer('127.0.0.1', 0, '127.0.0.1', 0, compress_level=6, compress_side='client',
+                           migrate_timeout=0.2)
+
+    class FakeWriter:
+        closed = False
+        def write(self, data):
+            pass
+        async def drain(self):
+            pass
+        def close(self):
+            self.closed = True
+
+    new_writer = FakeWriter()
+    await relay._hand_over('stream', CompressedReader(reader, stats), CompressedWriter(writer, 6, stats),
+                           asyncio.StreamReader(), new_writer)
+    # The peer never sent its handover frame: neither path is left half-used
+    assert new_writer.closed
+    assert writer.is_closing()
+    assert 'stream' not in relay.migrated_streams
+
+@pytest.mark.asyncio
+async def test_relay_stream_migrates_to_direct_path():
+    echo = await asyncio.start_server(handle_echo, '127.0.0.1', 0)
+    echo_port = echo.sockets[0].getsockname()[1]
+    rendezvous_port, far_port, middle_port, local_port = free_port(), free_port(), free_port(), free_port()
+    rendezvous = Server('127.0.0.1', rendezvous_port)
+
+    # The far relay is only reachable through the middle relay until the punch succeeds
+    far = TCPRelayServer('127.0.0.1', far_port, '127.0.0.1', echo_port, compress_side='client',
+                         migrate=True, rendezvous=('127.0.0.1', rendezvous_port))
+    middle = TCPRelayServer('127.0.0.1', middle_port, '127.0.0.1', far_port)
+    middle_released = asyncio.Event()
+    handle_middle = middle.handle_client
+
+    async def track_middle(reader, writer):
+        await handle_middle(reader, writer)
+        middle_released.set()
+    middle.handle_client = track_middle
+    local = TCPRelayServer('127.0.0.1', local_port, '127.0.0.1', middle_port, compress_side='target',
+                           migrate=True, rendezvous=('127.0.0.1', rendezvous_port))
+    tasks = [asyncio.create_task(rendezvous.start())]
+    await asyncio.sleep(0.1)
+    tasks += [asyncio.create_task(relay.start()) for relay in (far, middle, local)]
+    await asyncio.sleep(0.2)
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', local_port)
+    sent = b''
+    for i in range(50):
+        chunk = f'message {i}\n'.encode() * 20
+        sent += chunk
+        writer.write(chunk)
+        await writer.drain()
+        await asyncio.sleep(0.01)
+    received = await asyncio.wait_for(reader.readexactly(len(sent)), timeout=5)
+    assert received == sent
+    # A refused first punch attempt delays migration by the punch retry delay
+    for _ in range(250):
+        if list(local.migrated_streams.values()) == list(far.migrated_streams.values()) == [True]:
+            break
+        await asyncio.sleep(0.02)
+    assert list(local.migrated_streams.values()) == [True]
+    assert list(far.migrated_streams.values()) == [True]
+
+    # The middle relay has been released and the stream keeps flowing without it
+    await asyncio.wait_for(middle_released.wait(), timeout=5)
+    writer.write(b'after migration\n')
+    await writer.drain()
+    assert await asyncio.wait_for(reader.readline(), timeout=5) == b'after migration\n'
+
+    writer.close()
+    for task in tasks:
+        task.cancel()
+    echo.close()
+    await echo.wait_closed()
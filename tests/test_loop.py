@@ -0,0 +1,25 @@
+import asyncio
+import subprocess
+import sys
+from src.loop import install_event_loop
+
+def test_install_default_asyncio_loop():
+    assert install_event_loop('asyncio') == 'asyncio'
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+
+def test_install_auto_falls_back_without_uvloop():
+    try:
+        import uvloop  # noqa: F401
+        expected = 'uvloop'
+    except ImportError:
+        expected = 'asyncio'
+    try:
+        assert install_event_loop('auto') == expected
+    finally:
+        install_event_loop('asyncio')
+
+def test_package_import_is_lazy():
+    code = ("import sys, src; loaded = [m for m in sys.modules if m.startswith('src.')]; "
+            "assert not loaded, loaded; src.Server; assert 'src.server' in sys.modules; "
+            "assert 'src.client' not in sys.modules")
+    subprocess.run([sys.executable, '-c', code], check=True)
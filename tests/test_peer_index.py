@@ -0,0 +1,73 @@
+import pytest
+from src.peer_index import TagIndex, _SortedIds, validate_tags
+
+@pytest.fixture
+def index():
+    index = TagIndex()
+    for i in range(10):
+        index.add(f'peer{i}', {'role': 'relay' if i % 2 else 'edge', 'region': 'eu' if i < 5 else 'us'})
+    return index
+
+def test_query_intersects_tags(index):
+    page, cursor = index.query({'role': 'relay', 'region': 'eu'})
+    assert [peer_id for peer_id, _ in page] == ['peer1', 'peer3']
+    assert cursor is None
+    assert index.query({'role': 'unknown'}) == ([], None)
+
+def test_query_paginates_with_cursor(index):
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = index.query({'role': 'edge'}, limit=2, cursor=cursor)
+        seen.extend(peer_id for peer_id, _ in page)
+        if cursor is None:
+            break
+    assert seen == ['peer0', 'peer2', 'peer4', 'peer6', 'peer8']
+
+def test_paging_matches_full_scan(monkeypatch):
+    # Small chunks so inserts and removals split and drop chunks
+    monkeypatch.setattr(_SortedIds, 'CHUNK', 4)
+    index = TagIndex()
+    for i in range(500):
+        index.add(f'peer{i:03d}', {'role': ('relay', 'edge', 'seed')[i % 3], 'region': ('eu', 'us')[i % 2]})
+    for i in range(0, 500, 7):
+        index.remove(f'peer{i:03d}')
+    for i in range(0, 500, 5):
+        if f'peer{i:03d}' in index:
+            index.add(f'peer{i:03d}', dict(index.tags[f'peer{i:03d}'], zone='a'))
+
+    for filters in (None, {'role': 'relay'}, {'role': 'edge', 'region': 'us'},
+                    {'role': 'seed', 'region': 'eu', 'zone': 'a'}):
+        expected = sorted(peer_id for peer_id, tags in index.tags.items()
+                          if all(tags.get(k) == v for k, v in (filters or {}).items()))
+        seen, cursor = [], None
+        while True:
+            page, cursor = index.query(filters, limit=17, cursor=cursor)
+            seen.extend(peer_id for peer_id, _ in page)
+            if cursor is None:
+                break
+        assert seen == expected
+
+def test_disjoint_filters_skip_ahead():
+    index = TagIndex()
+    for i in range(20000):
+        index.add(f'peer{i:05d}', {'half': 'low' if i < 10000 else 'high', 'all': 'yes'})
+    assert index.query({'half': 'low', 'all': 'yes'}, limit=1)[0] == [('peer00000', {'half': 'low', 'all': 'yes'})]
+    assert index.query({'half': 'low', 'half2': 'x'}) == ([], None)
+    index.add('zzz', {'half': 'low'})
+    assert index.query({'half': 'low'}, cursor='peer09999') == ([('zzz', {'half': 'low'})], None)
+
+def test_remove_and_replace_update_index(index):
+    index.remove('peer1')
+    index.add('peer3', {'role': 'edge'})
+    page, _ = index.query({'role': 'relay'})
+    assert [peer_id for peer_id, _ in page] == ['peer5', 'peer7', 'peer9']
+    assert ('region', 'eu') in index.index
+    assert 'peer3' not in index.index[('region', 'eu')]
+
+def test_validate_tags():
+    assert validate_tags({'port': 8000}) == {'port': '8000'}
+    with pytest.raises(ValueError):
+        validate_tags(['role'])
+    with pytest.raises(ValueError):
+        validate_tags({'role': {'nested': 'value'}})
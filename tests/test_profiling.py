@@ -0,0 +1,63 @@
+import pytest
+import asyncio
+import os
+import pstats
+import time
+from src.profiling import LoopLagMonitor, ProfilingMode, format_tasks
+
+@pytest.mark.asyncio
+async def test_lag_monitor_detects_blocking_call():
+    monitor = LoopLagMonitor(interval=0.01, warn_threshold=1.0)
+    monitor.start()
+    await asyncio.sleep(0.02)
+    time.sleep(0.1)  # Block the event loop
+    await asyncio.sleep(0.02)
+    monitor.stop()
+
+    assert monitor.samples > 0
+    assert monitor.max_lag >= 0.05
+
+@pytest.mark.asyncio
+async def test_slow_callback_monitor_without_debug_mode():
+    original = asyncio.Handle._run
+    profiling = ProfilingMode(slow_callback=0.05)
+    profiling.install()
+    try:
+        assert not asyncio.get_event_loop().get_debug()
+        asyncio.get_event_loop().call_soon(time.sleep, 0.1)
+        await asyncio.sleep(0.01)
+        assert profiling.slow_monitor.slow_callbacks == 1
+    finally:
+        profiling.uninstall()
+    assert asyncio.Handle._run is original
+
+@pytest.mark.asyncio
+async def test_format_tasks_includes_stacks():
+    async def sleeper():
+        await asyncio.sleep(10)
+
+    task = asyncio.create_task(sleeper(), name='sleeper-task')
+    await asyncio.sleep(0)
+    dump = format_tasks()
+    task.cancel()
+
+    assert 'sleeper-task' in dump
+    assert 'sleeper' in dump
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('profiler', ['cprofile', 'sampling'])
+async def test_toggle_profiler_writes_output(tmp_path, profiler):
+    profiling = ProfilingMode(profiler=profiler, output=str(tmp_path / 'prof'))
+    assert profiling.toggle_profiler() is None
+    end = time.monotonic() + 0.05
+    while time.monotonic() < end:
+        sum(range(1000))
+        await asyncio.sleep(0)
+    path = profiling.toggle_profiler()
+
+    assert os.path.exists(path)
+    if profiler == 'cprofile':
+        assert pstats.Stats(path).total_calls > 0
+    else:
+        with open(path) as f:
+            assert f.read().strip()
@@ -0,0 +1,92 @@
+import pytest
+import asyncio
+import json
+from src.serialization import FrameCache, Serializer, encode_frame, encode_frame_chunked
+
+class RecordingPeer:
+    def __init__(self, fail=False):
+        self.frames = []
+        self.fail = fail
+
+    async def send_frame(self, frame):
+        if self.fail:
+            raise Exception("Failed to send message: closed")
+        self.frames.append(frame)
+
+def test_chunked_encoding_matches_json_dumps():
+    message = {'type': 'peer_list', 'peers': [f'10.0.0.{i % 255}:{i}' for i in range(12345)],
+               'nested': {'a': [1, 2.5, None, True]}, 'text': 'café "quoted"'}
+    assert encode_frame_chunked(message, chunk_items=1000) == encode_frame(message)
+    assert json.loads(encode_frame_chunked(message, chunk_items=1000)) == message
+
+    tags = {'type': 'tags', 'tags': {f'peer{i}': {'role': 'relay'} for i in range(2500)}, 'empty': {}}
+    assert encode_frame_chunked(tags, chunk_items=1000) == encode_frame(tags)
+
+def test_frame_cache_evicts_least_recently_used():
+    cache = FrameCache(max_bytes=30)
+    cache.put('a', b'x' * 10)
+    cache.put('b', b'y' * 10)
+    cache.put('c', b'z' * 10)
+    assert cache.get('a') == b'x' * 10
+    cache.put('d', b'w' * 10)
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('d') is not None
+    assert cache.size == 30
+    cache.put('huge', b'h' * 31)
+    assert cache.get('huge') is None
+
+@pytest.mark.asyncio
+async def test_fan_out_encodes_once_and_counts_failures():
+    serializer = Serializer()
+    peers = [RecordingPeer(), RecordingPeer(), RecordingPeer(fail=True)]
+
+    failed = await serializer.fan_out(peers, {'type': 'text', 'data': 'hello'})
+
+    assert failed == 1
+    assert peers[0].frames == [b'{"type": "text", "data": "hello"}\n']
+    assert peers[0].frames[0] is peers[1].frames[0]
+
+@pytest.mark.asyncio
+async def test_large_message_is_encoded_off_loop():
+    serializer = Serializer(offload_items=100, chunk_items=50)
+    message = {'type': 'peer_list', 'peers': list(range(1000))}
+
+    frame = await serializer.encode(message)
+    assert frame == encode_frame(message)
+    assert serializer.executor is not None
+    serializer.close()
+
+    small = Serializer(offload_items=100)
+    await small.encode({'type': 'peer_list', 'peers': [1, 2, 3]})
+    assert small.executor is None
+
+@pytest.mark.asyncio
+async def test_cached_async_shares_one_encoding():
+    serializer = Serializer()
+    calls = []
+
+    def build():
+        calls.append(1)
+        return {'type': 'peer_list', 'peers': ['a', 'b']}
+
+    frames = await asyncio.gather(*(serializer.cached_async(('peer_list', 1), build) for _ in range(5)))
+    assert len(calls) == 1
+    assert len(set(frames)) == 1
+    assert await serializer.cached_async(('peer_list', 1), build) == frames[0]
+    assert serializer.cache.hits >= 1
+
+@pytest.mark.asyncio
+async def test_frame_discarded_while_encoding_is_not_cached():
+    serializer = Serializer(offload_items=100, chunk_items=50)
+    key = ('peer_list', 1)
+    pending = asyncio.ensure_future(
+        serializer.cached_async(key, lambda: {'type': 'peer_list', 'peers': list(range(1000))}))
+    await asyncio.sleep(0)
+    serializer.discard(key)
+
+    frame = await pending
+    assert json.loads(frame)['peers'][-1] == 999
+    assert serializer.cache.get(key) is None
+    assert serializer.cache.size == 0
+    serializer.close()
@@ -1,5 +1,7 @@
 import pytest
 import asyncio
+import json
+import socket
 from src.server import Server
 
 @pytest.fixture
@@ -23,3 +25,81 @@ async def test_server_start(server):
         await server_task
     except asyncio.CancelledError:
         pass
+
+@pytest.mark.asyncio
+async def test_server_query_peers_by_tag():
+    server = Server('127.0.0.1', 0)
+    # Bind to a fixed free port so clients know where to connect
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        server.port = s.getsockname()[1]
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.1)
+
+    async def send(writer, message):
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+
+    clients = []
+    for role in ('relay', 'edge', 'relay'):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        await send(writer, {'type': 'register', 'tags': {'role': role}})
+        ack = json.loads(await reader.readline())
+        clients.append((reader, writer, ack['peer_id']))
+
+    reader, writer, _ = clients[1]
+    await send(writer, {'type': 'query_peers', 'tags': {'role': 'relay'}, 'limit': 1, 'request_id': 'q1'})
+    first = json.loads(await reader.readline())
+    await send(writer, {'type': 'query_peers', 'tags': {'role': 'relay'}, 'limit': 1, 'cursor': first['next_cursor']})
+    second = json.loads(await reader.readline())
+
+    relays = sorted([clients[0][2], clients[2][2]])
+    assert first['request_id'] == 'q1'
+    assert [p['peer_id'] for p in first['peers'] + second['peers']] == relays
+    assert second['next_cursor'] is None
+
+    clients[0][1].close()
+    await asyncio.sleep(0.1)
+    assert clients[0][2] not in server.tag_index
+
+    for _, w, _ in clients[1:]:
+        w.close()
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
+
+@pytest.mark.asyncio
+async def test_server_peer_list_cache_follows_membership():
+    server = Server('127.0.0.1', 0)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        server.port = s.getsockname()[1]
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.1)
+
+    async def list_peers(reader, writer):
+        writer.write(json.dumps({'type': 'list_peers'}).encode() + b'\n')
+        await writer.drain()
+        return json.loads(await reader.readline())['peers']
+
+    reader1, writer1 = await asyncio.open_connection('127.0.0.1', server.port)
+    first = await list_peers(reader1, writer1)
+    assert await list_peers(reader1, writer1) == first
+    assert server.serializer.cache.hits == 1
+
+    reader2, writer2 = await asyncio.open_connection('127.0.0.1', server.port)
+    await asyncio.sleep(0.05)
+    assert len(await list_peers(reader1, writer1)) == 2
+
+    writer2.close()
+    await asyncio.sleep(0.05)
+    assert await list_peers(reader1, writer1) == first
+
+    writer1.close()
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass